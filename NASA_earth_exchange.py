@@ -1,6 +1,7 @@
 from urllib.error import HTTPError
 import time
 import geopandas as gpd
+import shapely
 import os
 import numpy as np
 import wget
@@ -10,6 +11,794 @@ from termcolor import colored
 from concurrent.futures import ThreadPoolExecutor, as_completed, ProcessPoolExecutor
 import psutil
 from datetime import datetime
+from functools import lru_cache
+import json
+import hashlib
+import sqlite3
+import threading
+import asyncio
+import random
+import queue
+import shutil
+import tempfile
+import io
+import copy
+import tarfile
+import zipfile
+import zlib
+import importlib.util
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import aiohttp
+except ImportError:  # only needed by download_all_async
+    aiohttp = None
+
+
+def _format_station_values(values):
+    # Values arrive rounded and filled by their variable transform; the whole block is formatted in a single
+    # vectorized pass, as the shortest text of each float32 value
+    return values.astype('U16')
+
+
+def _write_station_block(file_paths, date_string, values, paired_values=None, block_bytes=64 * 1024 ** 2,
+                         output=None):
+    # values (and paired_values for tmax,tmin files) are (days x cells) arrays, one column per file in file_paths;
+    # without a date_string the rows are appended to existing station files
+    if date_string is None and values.shape[0] == 0:
+        return
+    output = DirectoryOutput() if output is None else output
+    cells_per_block = max(1, block_bytes // (64 * max(1, values.shape[0])))
+    for start in range(0, len(file_paths), cells_per_block):
+        stop = min(start + cells_per_block, len(file_paths))
+        text = _format_station_values(values[:, start:stop]).T
+        if paired_values is not None:
+            text = np.char.add(np.char.add(text, ','), _format_station_values(paired_values[:, start:stop]).T)
+        for file_path, lines in zip(file_paths[start:stop], text):
+            if date_string is None:
+                output.write(file_path, '\n'.join(lines) + '\n', append=True)
+            else:
+                output.write(file_path, date_string + '\n' + '\n'.join(lines) + '\n')  # date header and values
+
+
+def _write_station_part(output, *args):
+    # Process pool task: a worker's copy of the output backend is flushed before its results are reported
+    _write_station_block(*args, output=output)
+    output.flush()
+
+
+_manifest_lock = threading.Lock()
+# The netCDF-C library is not thread-safe: every netCDF access made from download threads goes through this lock
+netcdf_lock = threading.RLock()
+
+
+def _nc_calendar(time_var):
+    # CF calendar of a time variable, "standard" when the file does not name one
+    return time_var.calendar if hasattr(time_var, 'calendar') else 'standard'
+
+
+def _expected_days(year, calendar):
+    # Number of days a yearly file should hold under the file's own calendar
+    if calendar == "360_day":
+        return 360
+    if calendar in ["noleap", "365_day"]:
+        return 365
+    if calendar in ["all_leap", "366_day"]:
+        return 366
+    if calendar == "julian":
+        return 366 if year % 4 == 0 else 365
+    return 366 if year % 4 == 0 and (year % 100 != 0 or year % 400 == 0) else 365
+
+
+def _sha256(file_path, chunk_size=1024 ** 2):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _AdaptiveLimiter:
+    # AIMD limit on in-flight requests: grows slowly while responses are fast and healthy,
+    # shrinks on 5xx responses and when latency rises well above the best observed
+    def __init__(self, initial, minimum=1, maximum=64, latency_factor=2.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self.base_latency = None
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency, server_error):
+        async with self._cond:
+            self.in_flight -= 1
+            if latency is not None:
+                self.base_latency = latency if self.base_latency is None else min(self.base_latency, latency)
+            if server_error:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif latency is not None and latency > self.latency_factor * self.base_latency:
+                self.limit = max(self.minimum, self.limit * 0.9)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)  # about +1 per full window
+            self._cond.notify_all()
+
+
+def _write_nc_grid(dst_path, data_file, var, time_values, latitudes, longitudes, values):
+    # Write var on the given time/lat/lon axes into a new netCDF3 file, copying attributes from an open dataset
+    with nc.Dataset(dst_path, "w", format="NETCDF3_64BIT_OFFSET") as dst:
+        dst.setncatts({name: data_file.getncattr(name) for name in data_file.ncattrs()})
+        dst.createDimension("time", None)
+        dst.createDimension("lat", len(latitudes))
+        dst.createDimension("lon", len(longitudes))
+        for name, data in [("time", time_values), ("lat", latitudes), ("lon", longitudes), (var, values)]:
+            src_var = data_file.variables[name]
+            attrs = {key: src_var.getncattr(key) for key in src_var.ncattrs() if key != "_FillValue"}
+            fill_value = src_var.getncattr("_FillValue") if "_FillValue" in src_var.ncattrs() else None
+            dst_var = dst.createVariable(name, src_var.dtype, src_var.dimensions, fill_value=fill_value)
+            dst_var.setncatts(attrs)
+            dst_var[:] = data
+
+
+def _write_nc_subset(dst_path, data_file, var, time_idx):
+    # Copy the selected days of var (with time, lat and lon) from an open dataset into a new netCDF3 file
+    _write_nc_grid(dst_path, data_file, var, data_file.variables["time"][time_idx],
+                   data_file.variables["lat"][:], data_file.variables["lon"][:], data_file.variables[var][time_idx])
+
+
+def _stitch_tiles(dst_path, tile_paths, var, west, grid_res):
+    # Place every tile on the union lat/lon axes; the axes must be evenly spaced at grid_res, each tile must
+    # share the same time axis, overlapping cells must agree, and the stitched grid must have no holes
+    tiles = [nc.Dataset(tile_path, mode='r') for tile_path in tile_paths]
+    try:
+        tile_lats = [np.asarray(tile.variables['lat'][:], dtype=float) for tile in tiles]
+        tile_lons = [np.asarray(tile.variables['lon'][:], dtype=float) for tile in tiles]
+        # Order longitudes eastwards from the west edge, so boxes across the 0/360 seam stay contiguous
+        tile_keys = [(lons - west) % 360 for lons in tile_lons]
+        latitudes = np.unique(np.round(np.concatenate(tile_lats), 6))
+        lon_keys, key_idx = np.unique(np.round(np.concatenate(tile_keys), 6), return_index=True)
+        longitudes = np.concatenate(tile_lons)[key_idx]
+        for axis, name in [(latitudes, "lat"), (lon_keys, "lon")]:
+            if len(axis) > 1 and not np.allclose(np.diff(axis), grid_res, atol=1e-4):
+                raise ValueError(f"tiles do not line up on a {grid_res} degree {name} axis")
+
+        time_values = tiles[0].variables['time'][:]
+        values = np.full((len(time_values), len(latitudes), len(longitudes)), np.nan, dtype=np.float32)
+        covered = np.zeros((len(latitudes), len(longitudes)), dtype=bool)
+        for tile, lats, keys in zip(tiles, tile_lats, tile_keys):
+            if not np.array_equal(tile.variables['time'][:], time_values):
+                raise ValueError("tiles have different time axes")
+            lat_idx = np.searchsorted(latitudes, np.round(lats, 6))
+            lon_idx = np.searchsorted(lon_keys, np.round(keys, 6))
+            tile_values = np.ma.filled(tile.variables[var][:].astype(np.float32), np.nan)
+            overlap = covered[np.ix_(lat_idx, lon_idx)]
+            if overlap.any() and not np.allclose(values[:, lat_idx][:, :, lon_idx][:, overlap],
+                                                 tile_values[:, overlap], equal_nan=True):
+                raise ValueError("overlapping tiles disagree")
+            values[np.ix_(np.arange(len(time_values)), lat_idx, lon_idx)] = tile_values
+            covered[np.ix_(lat_idx, lon_idx)] = True
+        if not covered.all():
+            raise ValueError(f"stitched grid has {int((~covered).sum())} uncovered cells")
+
+        _write_nc_grid(dst_path, tiles[0], var, time_values, latitudes, longitudes, np.ma.masked_invalid(values))
+    finally:
+        for tile in tiles:
+            tile.close()
+
+
+class DownloadMetrics:
+    # Workers only push events onto a queue; a single writer thread appends them to the machine-readable
+    # event log (nc2swat_events.jsonl) and to downloadednc.log, prints progress and keeps the live counters
+    def __init__(self, working_dir, progress_interval=10.0):
+        self.events_path = os.path.join(working_dir, "nc2swat_events.jsonl")
+        self.log_path = os.path.join(working_dir, "downloadednc.log")
+        self.progress_interval = progress_interval
+        self.counters = {"files_total": 0, "files_ok": 0, "files_failed": 0, "requests": 0,
+                         "server_errors": 0, "bytes": 0, "in_flight": 0}
+        self.started = time.time()
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def start(self, total_files):
+        self._queue.put(("start", total_files))
+
+    def request_started(self):
+        self._queue.put(("in_flight", 1))
+
+    def request(self, model, ssp, var, year, vers, status, latency, nbytes=0, attempt=1, end_year=None):
+        # end_year marks a batched request covering year..end_year
+        self._queue.put(("in_flight", -1))
+        event = {"event": "request", "model": model, "ssp": ssp, "var": var, "year": int(year),
+                 "vers": vers, "status": status, "latency": round(latency, 3), "bytes": nbytes, "attempt": attempt}
+        if end_year is not None:
+            event["end_year"] = int(end_year)
+        self._queue.put(("event", event))
+
+    def file(self, model, ssp, var, year, vers, ok, retries):
+        self._queue.put(("event", {"event": "file", "model": model, "ssp": ssp, "var": var, "year": int(year),
+                                   "vers": vers, "status": "ok" if ok else "failed", "retries": retries}))
+
+    def log(self, line):
+        self._queue.put(("log", line))
+
+    def message(self, text):
+        self._queue.put(("print", text))
+
+    @contextmanager
+    def stage(self, name, **info):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._queue.put(("event", {"event": "stage", "stage": name,
+                                       "seconds": round(time.perf_counter() - start, 3), **info}))
+            self.flush()
+
+    def flush(self):
+        self._queue.join()
+
+    def snapshot(self):
+        counters = dict(self.counters)
+        elapsed = max(time.time() - self.started, 1e-9)
+        done = counters["files_ok"] + counters["files_failed"]
+        counters["files_per_s"] = round(done / elapsed, 2)
+        counters["mb_per_s"] = round(counters["bytes"] / 1024 ** 2 / elapsed, 2)
+        counters["error_rate"] = round(counters["server_errors"] / max(1, counters["requests"]), 3)
+        remaining = max(0, counters["files_total"] - done)
+        counters["eta_s"] = round(remaining / (done / elapsed)) if done else None
+        return counters
+
+    def _count(self, event):
+        # Files already on disk ("cached") made no request; only 5xx answers and connection errors are server errors
+        if event["event"] == "request" and event["status"] != "cached":
+            self.counters["requests"] += 1
+            self.counters["bytes"] += event["bytes"] or 0
+            status = event["status"]
+            if status == "error" or (isinstance(status, int) and status >= 500):
+                self.counters["server_errors"] += 1
+        elif event["event"] == "file":
+            self.counters["files_ok" if event["status"] == "ok" else "files_failed"] += 1
+
+    def _progress_line(self):
+        snapshot = self.snapshot()
+        eta = "--:--" if snapshot["eta_s"] is None else f"{snapshot['eta_s'] // 60:02d}:{snapshot['eta_s'] % 60:02d}"
+        return (f"  ... {snapshot['files_ok'] + snapshot['files_failed']}/{snapshot['files_total']} files, "
+                f"{snapshot['files_per_s']} files/s, {snapshot['mb_per_s']} MB/s, "
+                f"in-flight: {snapshot['in_flight']}, errors: {snapshot['error_rate']:.1%}, ETA {eta}")
+
+    def _run(self):
+        last_progress = time.time()
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            events, log_lines = [], []
+            for kind, payload in items:
+                if kind == "event":
+                    self._count(payload)
+                    payload["ts"] = round(time.time(), 3)
+                    events.append(json.dumps(payload))
+                elif kind == "log":
+                    log_lines.append(payload)
+                elif kind == "print":
+                    print(payload)
+                elif kind == "in_flight":
+                    self.counters["in_flight"] += payload
+                elif kind == "start":
+                    self.counters["files_total"] += payload
+            # One append per drained batch instead of one open/close per event
+            for path, lines in [(self.events_path, events), (self.log_path, log_lines)]:
+                if lines:
+                    with open(path, "a") as f:
+                        f.write("\n".join(lines) + "\n")
+            if self.counters["files_total"] and time.time() - last_progress >= self.progress_interval:
+                print(colored(self._progress_line(), 'cyan'))
+                last_progress = time.time()
+            for _ in items:
+                self._queue.task_done()
+
+
+@lru_cache(maxsize=64)
+def _open_store(store_path):
+    # Memory-map a consolidated (cells x days) array together with its grid and time axis
+    with open(store_path + ".json") as f:
+        meta = json.load(f)
+    data = np.load(store_path + ".npy", mmap_mode='r')
+    dates = np.load(store_path + ".time.npy")
+    return data, dates, meta
+
+
+def _write_swatplus_block(file_paths, headers, row_prefix, values, paired_values=None, block_bytes=64 * 1024 ** 2,
+                          output=None):
+    # SWAT+ station files: per-file header lines, then one "year jday value(s)" row per day;
+    # without headers the rows are appended to existing station files
+    if headers is None and values.shape[0] == 0:
+        return
+    output = DirectoryOutput() if output is None else output
+    cells_per_block = max(1, block_bytes // (64 * max(1, values.shape[0])))
+    for start in range(0, len(file_paths), cells_per_block):
+        stop = min(start + cells_per_block, len(file_paths))
+        text = np.char.rjust(_format_station_values(values[:, start:stop]).T, 10)
+        if paired_values is not None:
+            text = np.char.add(text, np.char.rjust(_format_station_values(paired_values[:, start:stop]).T, 10))
+        text = np.char.add(row_prefix, text)
+        for i, (file_path, lines) in enumerate(zip(file_paths[start:stop], text)):
+            output.write(file_path, ('' if headers is None else headers[start + i] + '\n') + '\n'.join(lines) + '\n',
+                         append=headers is None)
+
+
+def _last_line(file_path, tail_bytes=4096):
+    # Last row of a text output, or None when the file does not end with a complete line (an interrupted write)
+    with open(file_path, 'rb') as f:
+        f.seek(max(0, os.path.getsize(file_path) - tail_bytes))
+        tail = f.read()
+    if not tail.endswith(b'\n'):
+        return None
+    return tail[:-1].rsplit(b'\n', 1)[-1].decode()
+
+
+def _update_swatplus_nbyr(file_path, last_year):
+    # nbyr is the fixed-width first field of the third header line, so it is rewritten in place after an append
+    with open(file_path, 'r+b') as f:
+        offset = len(f.readline()) + len(f.readline())
+        f.readline()
+        first_year = int(f.readline()[:4])
+        f.seek(offset)
+        f.write(f"{last_year - first_year + 1:>4}".encode())
+
+
+def _encode(data):
+    # Text is written with the platform line endings, as text-mode files would be, so every backend stores the
+    # same bytes
+    if isinstance(data, bytes):
+        return data
+    return (data if os.linesep == '\n' else data.replace('\n', os.linesep)).encode()
+
+
+class DirectoryOutput:
+    # Output files written straight into the folders the writers name, one open/write/close per write
+    name = "directory"
+    concurrent = True  # several processes can write at once
+
+    def __init__(self):
+        self._folders = set()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_folders"] = set()
+        return state
+
+    def begin(self, downloader, targets=()):
+        self._folders = set()
+
+    def station_path(self, file_path):
+        return file_path
+
+    def station_name(self, filename):
+        # A station file as index and .cli files list it, relative to its scenario folder
+        return filename
+
+    def exists(self, file_path):
+        return os.path.exists(file_path)
+
+    def _makedirs(self, file_path):
+        # One makedirs per folder and run instead of one per file
+        folder = os.path.dirname(file_path)
+        if folder not in self._folders:
+            os.makedirs(folder, exist_ok=True)
+            self._folders.add(folder)
+
+    def write(self, file_path, data, append=False):
+        self._makedirs(file_path)
+        with open(file_path, 'ab' if append else 'wb', buffering=1024 ** 2) as f:
+            f.write(_encode(data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class CombiningOutput(DirectoryOutput):
+    # Write-combining directory writer: a bounded LRU pool of open handles with large buffers, so the blocks
+    # written to a station file (headers, rows, appended years) go out in few large writes without reopening it
+    name = "combined"
+
+    def __init__(self, max_handles=256, buffer_bytes=4 * 1024 ** 2):
+        super().__init__()
+        self.max_handles = max_handles
+        self.buffer_bytes = buffer_bytes
+        self._handles = OrderedDict()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_handles"] = OrderedDict()
+        return state
+
+    def write(self, file_path, data, append=False):
+        handle = self._handles.pop(file_path, None)
+        if handle is not None and not append:
+            handle.close()
+            handle = None
+        if handle is None:
+            self._makedirs(file_path)
+            handle = open(file_path, 'ab' if append else 'wb', buffering=self.buffer_bytes)
+            while len(self._handles) >= self.max_handles:
+                self._handles.popitem(last=False)[1].close()
+        self._handles[file_path] = handle
+        handle.write(_encode(data))
+
+    def flush(self):
+        while self._handles:
+            self._handles.popitem(last=False)[1].close()
+
+
+class ShardedOutput(DirectoryOutput):
+    # Station files spread over numbered subfolders of their scenario folder by a hash of the file name, so no
+    # directory holds more than a fraction of the stations; index and .cli files stay in place and list the
+    # stations by their shard-relative names
+    name = "sharded"
+
+    def __init__(self, shards=64):
+        super().__init__()
+        self.shards = shards
+
+    def station_name(self, filename):
+        return f"{zlib.crc32(filename.encode()) % self.shards:03d}/{filename}"
+
+    def station_path(self, file_path):
+        folder, filename = os.path.split(file_path)
+        return os.path.join(folder, *self.station_name(filename).split("/"))
+
+
+class _ArchiveOutput(DirectoryOutput):
+    # All outputs of a run streamed into one archive, named by their path relative to the working directory; the
+    # archive is written to a .tmp file and renamed when the run completes. Every run rewrites it in full
+    concurrent = False  # a single stream, written by one process
+    extension = None
+
+    def __init__(self, archive_path=None):
+        super().__init__()
+        self.archive_path = archive_path
+        self._archive = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_archive"] = None
+        return state
+
+    def begin(self, downloader, targets=()):
+        # The default name carries the targets written, so convert_to_swat and export(["swatplus"]) of the same
+        # model do not replace each other's archive
+        if self._archive is None:
+            self.root = downloader.working_dir
+            self.path = self.archive_path or os.path.join(
+                downloader.working_dir,
+                f"{downloader.model_name}{downloader.output_suffix}{''.join(f'_{target}' for target in targets)}"
+                f"_outputs.{self.extension}")
+            self._archive = self._open(self.path + ".tmp")
+
+    def exists(self, file_path):
+        return False
+
+    def write(self, file_path, data, append=False):
+        if append:
+            raise ValueError(f"{self.name} archives cannot append to {file_path}")
+        self._add(os.path.relpath(file_path, self.root).replace(os.sep, '/'), _encode(data))
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+            os.replace(self.path + ".tmp", self.path)
+            print(f"  ... {self.path}" + colored(" ... archived", 'green'))
+
+
+class TarOutput(_ArchiveOutput):
+    name = "tar"
+
+    def __init__(self, archive_path=None, compression=""):
+        super().__init__(archive_path)
+        self.compression = compression  # "", "gz", "bz2" or "xz"
+        self.extension = "tar" + (f".{compression}" if compression else "")
+
+    def _open(self, path):
+        return tarfile.open(path, f"w|{self.compression}")
+
+    def _add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime, info.mode = len(data), time.time(), 0o644
+        self._archive.addfile(info, io.BytesIO(data))
+
+
+class ZipOutput(_ArchiveOutput):
+    name = "zip"
+    extension = "zip"
+
+    def _open(self, path):
+        return zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+
+    def _add(self, name, data):
+        self._archive.writestr(name, data)
+
+
+# Where ClimateDataDownloader.output_backend puts station files, index files and tables; an instance of one of
+# these classes can be set instead to tune it, e.g. CombiningOutput(max_handles=64) or TarOutput(compression="gz")
+OUTPUT_BACKENDS = {
+    "directory": DirectoryOutput,
+    "combined": CombiningOutput,
+    "sharded": ShardedOutput,
+    "tar": TarOutput,
+    "zip": ZipOutput,
+}
+
+
+class SwatWriter:
+    # SWAT station .txt files: start date on the first line, one value (or "tmax,tmin") per day
+    name = "swat"
+    cell_chunks = True  # can be handed one block of cells at a time
+
+    def folder(self, downloader):
+        return downloader._swat_folder()
+
+    def begin(self, downloader, units):
+        downloader._write_swat_indexes(downloader._swat_folder(), units)
+
+    def output_paths(self, downloader, ssp, variables, columns=None):
+        columns = downloader._unit_cells(variables)[0] if columns is None else columns
+        prefix, output = f'{downloader._swat_folder()}/{ssp}/{downloader._swat_prefix(variables)}', downloader._output()
+        return [output.station_path(f'{prefix}_{column}.txt') for column in columns]
+
+    def write(self, downloader, ssp, variables, frames, parallel=False):
+        date_string = frames[0].index.min().strftime("%Y%m%d")
+        file_paths = self.output_paths(downloader, ssp, variables, frames[0].columns)
+        paired_values = frames[1].to_numpy() if len(frames) == 2 else None
+        downloader.write_swat_stations(frames[0].to_numpy(), file_paths, date_string,
+                                       paired_values=paired_values, parallel=parallel)
+
+    def append(self, downloader, ssp, variables, frames):
+        file_paths = self.output_paths(downloader, ssp, variables, frames[0].columns)
+        paired_values = frames[1].to_numpy() if len(frames) == 2 else None
+        _write_station_block(file_paths, None, frames[0].to_numpy(), paired_values, output=downloader._output())
+
+    def last_date(self, downloader, file_path):
+        # Rows carry no dates: the start date on the first line plus the number of rows
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        if not data.endswith(b'\n'):
+            return None
+        return pd.Timestamp(data[:8].decode()) + pd.Timedelta(days=data.count(b'\n') - 2)
+
+
+class SwatPlusWriter:
+    # SWAT+ weather station files (pcp, tmp, hmd, wnd, slr) with their headers, listed in the matching .cli files
+    name = "swatplus"
+    cell_chunks = True
+    station_files = {
+        ("pr",): ("pcp", "precipitation"),
+        ("tasmax", "tasmin"): ("tmp", "temperature"),
+        ("hurs",): ("hmd", "humidity"),
+        ("sfcWind",): ("wnd", "wind speed"),
+        ("rsds",): ("slr", "solar radiation"),
+        ("rlds",): ("slr", "solar radiation"),  # only used when rsds was not downloaded
+    }
+    elevation = 100.0
+
+    def folder(self, downloader):
+        return f'{downloader.working_dir}/{downloader.model_name}{downloader.output_suffix}_SWATplus_files'
+
+    def begin(self, downloader, units):
+        # Pick the units SWAT+ has a station file for, and write the .cli lists next to the station files
+        unit_vars = {variables for ssp, variables in units}
+        self.files = {variables: self.station_files[variables] for variables in unit_vars
+                      if variables in self.station_files and not (variables == ("rlds",) and ("rsds",) in unit_vars)}
+        for variables in sorted(unit_vars - set(self.files)):
+            print(f"  ... {', '.join(variables)} has no SWAT+ station file" + colored(" ... skipped", 'yellow'))
+
+        self.cells = {}
+        save_folder = self.folder(downloader)
+        for variables, (ext, des) in sorted(self.files.items()):
+            columns, lat_lon_pairs = downloader._unit_cells(variables)
+            names = [f"{downloader._swat_prefix(variables)}_{column}.{ext}" for column in columns]
+            self.cells[variables] = dict(zip(columns, zip(names, lat_lon_pairs)))
+            listed = [downloader._output().station_name(name) for name in names]
+
+            firstline, secondline = downloader._header(f"{ext}.cli", f"{des} file names")
+            for folder in [save_folder] + [os.path.join(save_folder, ssp) for ssp in sorted({ssp for ssp, _ in units})]:
+                downloader._output().write(os.path.join(folder, f"{ext}.cli"),
+                                           firstline + '\n' + secondline + '\n' + '\n'.join(listed) + '\n')
+
+    def output_paths(self, downloader, ssp, variables, columns=None):
+        if variables not in self.files:
+            return []
+        cells = self.cells[variables]
+        output = downloader._output()
+        return [output.station_path(os.path.join(self.folder(downloader), ssp, cells[column][0]))
+                for column in (cells if columns is None else columns)]
+
+    def _row_prefix(self, index):
+        return np.char.add(index.year.to_numpy().astype('U4'), np.char.rjust(index.dayofyear.to_numpy().astype('U3'), 5))
+
+    def write(self, downloader, ssp, variables, frames, parallel=False):
+        if variables not in self.files:
+            return
+        ext, des = self.files[variables]
+        cells = [self.cells[variables][column] for column in frames[0].columns]
+        index = frames[0].index
+        row_prefix = self._row_prefix(index)
+        nbyr = len(np.unique(index.year))
+        time = datetime.now().strftime('- %m/%d/%y %H:%M:%S -')
+        headers = [f"{name}: {des} data - file written by ... {time}\n"
+                   f"{'nbyr':>4}{'tstep':>10}{'lat':>10}{'lon':>10}{'elev':>10}\n"
+                   f"{nbyr:>4}{0:>10}{float(lat):>10.3f}{float(lon):>10.3f}{self.elevation:>10.3f}"
+                   for name, (lat, lon) in cells]
+        file_paths = self.output_paths(downloader, ssp, variables, frames[0].columns)
+        paired_values = frames[1].to_numpy() if len(frames) == 2 else None
+        _write_swatplus_block(file_paths, headers, row_prefix, frames[0].to_numpy(), paired_values,
+                              output=downloader._output())
+
+    def append(self, downloader, ssp, variables, frames):
+        if variables not in self.files or len(frames[0]) == 0:
+            return
+        file_paths = self.output_paths(downloader, ssp, variables, frames[0].columns)
+        paired_values = frames[1].to_numpy() if len(frames) == 2 else None
+        _write_swatplus_block(file_paths, None, self._row_prefix(frames[0].index), frames[0].to_numpy(), paired_values,
+                              output=downloader._output())
+        downloader._output().flush()  # buffered rows reach the files before their headers are patched
+        for file_path in file_paths:
+            _update_swatplus_nbyr(file_path, frames[0].index.max().year)
+
+    def last_date(self, downloader, file_path):
+        # From the "year jday" prefix of the last row
+        line = _last_line(file_path)
+        return None if line is None else pd.Timestamp(int(line[:4]), 1, 1) + pd.Timedelta(days=int(line[4:9]) - 1)
+
+
+class _TableWriter:
+    # One table per (ssp, var): dates as rows, grid cells (lat_lon names) as columns, converted units
+    name = None
+    extension = None
+    cell_chunks = False  # every column of a table is needed at once
+
+    def folder(self, downloader):
+        return f'{downloader.working_dir}/{downloader.model_name}{downloader.output_suffix}_{self.name.upper()}_files'
+
+    def begin(self, downloader, units):
+        pass
+
+    def output_paths(self, downloader, ssp, variables):
+        return [os.path.join(self.folder(downloader), ssp, f"{var}.{self.extension}") for var in variables]
+
+    def write(self, downloader, ssp, variables, frames, parallel=False):
+        for var, file_path, frame in zip(variables, self.output_paths(downloader, ssp, variables), frames):
+            self._save(downloader._output(), frame.rename_axis('date'), file_path, downloader._transform(var))
+
+
+class CsvWriter(_TableWriter):
+    name = "csv"
+    extension = "csv"
+
+    def _save(self, output, frame, file_path, transform, mode='w'):
+        # Values were rounded by the transform; its decimals only fix the number of digits written
+        float_format = None if transform["decimals"] is None else f"%.{transform['decimals']}f"
+        output.write(file_path, frame.to_csv(header=mode == 'w', float_format=float_format, date_format="%Y-%m-%d",
+                                             lineterminator='\n'), append=mode == 'a')
+
+    def append(self, downloader, ssp, variables, frames):
+        for var, file_path, frame in zip(variables, self.output_paths(downloader, ssp, variables), frames):
+            self._save(downloader._output(), frame.rename_axis('date'), file_path, downloader._transform(var),
+                       mode='a')
+
+    def last_date(self, downloader, file_path):
+        line = _last_line(file_path)
+        return None if line is None else pd.Timestamp(line.split(',', 1)[0])
+
+
+class ParquetWriter(_TableWriter):
+    name = "parquet"
+    extension = "parquet"
+
+    def __init__(self):
+        # Checked when export() builds its writers, before any index, .cli or table file is written
+        if not any(importlib.util.find_spec(engine) for engine in ["pyarrow", "fastparquet"]):
+            raise ImportError("the parquet target requires pyarrow or fastparquet (conda install pyarrow)")
+
+    def _save(self, output, frame, file_path, transform):
+        output.write(file_path, frame.to_parquet())  # needs pyarrow or fastparquet
+
+
+# Output targets of ClimateDataDownloader.export(); any object with name, begin() and write() members can be passed
+# as well. folder() and output_paths() let incremental runs skip its up-to-date outputs, and append() with
+# last_date() (the day of an output's last row) lets it extend existing outputs with new years
+EXPORT_WRITERS = {
+    "swat": SwatWriter,
+    "swatplus": SwatPlusWriter,
+    "csv": CsvWriter,
+    "parquet": ParquetWriter,
+}
+
+
+# Per-variable conversion to SWAT inputs: value * scale + offset, rounded to decimals, with masked values and
+# missing days set to fill_value; missing_days is "fill", "interpolate" (linear between the neighbouring days)
+# or "error". Entries override TRANSFORM_DEFAULTS, and ClimateDataDownloader.transforms overrides both
+TRANSFORM_DEFAULTS = {"units": None, "scale": 1.0, "offset": 0.0, "decimals": 3, "fill_value": -99.0,
+                      "missing_days": "fill"}
+VARIABLE_TRANSFORMS = {
+    "tas": {"units": "K -> degC", "offset": -273.15},  # convert to degrees celsius
+    "tasmax": {"units": "K -> degC", "offset": -273.15},
+    "tasmin": {"units": "K -> degC", "offset": -273.15},
+    "pr": {"units": "kg m-2 s-1 -> mm/day", "scale": 86400.0},  # 1 kg/m2/s = 86400 mm/day
+    "rlds": {"units": "W m-2 -> MJ m-2", "scale": 0.0036},  # Convert to MJ/m^2
+    "rsds": {"units": "W m-2 -> MJ m-2", "scale": 0.0036},
+    "hurs": {"units": "%"},
+    "huss": {"units": "kg/kg"},
+    "sfcWind": {"units": "m/s"},
+}
+
+
+def _decode_nc_rows(variable, out, first=0, last=None, cell_idx=slice(None), lat_rows=slice(None),
+                    lon_cols=slice(None)):
+    # Decode days first:last of the lat_rows x lon_cols rectangle of a (time, lat, lon) variable straight into
+    # out, a (days x cells) view of the destination array; fill and missing values become NaN explicitly
+    # instead of through a masked array copy. cell_idx is relative to the rectangle
+    variable.set_auto_maskandscale(False)
+    raw = variable[first:last, lat_rows, lon_cols]
+    raw = raw.reshape(raw.shape[0], -1)[:, cell_idx]
+    out[...] = raw
+    masked = [getattr(variable, "_FillValue", nc.default_fillvals.get(raw.dtype.str[1:]))]
+    masked.extend(np.atleast_1d(getattr(variable, "missing_value", [])))
+    for value in masked:
+        if value is not None and not np.isnan(value):
+            out[raw == value] = np.nan
+    if hasattr(variable, "scale_factor"):  # packed data
+        out *= variable.scale_factor
+    if hasattr(variable, "add_offset"):
+        out += variable.add_offset
+
+
+def _apply_transform(data, missing_rows, transform, block_elements=1024 ** 2):
+    # One in-place float32 pass over cache-sized row blocks: scale, offset, rounding and fill value,
+    # after the missing days (rows) have been filled or interpolated
+    if missing_rows.any():
+        if transform["missing_days"] == "error":
+            raise ValueError(f"{missing_rows.sum()} missing days")
+        data[missing_rows] = np.nan
+        if transform["missing_days"] == "interpolate":
+            present = np.flatnonzero(~missing_rows)
+            for row in np.flatnonzero(missing_rows):
+                after = np.searchsorted(present, row)
+                if 0 < after < len(present):
+                    before, after = present[after - 1], present[after]
+                    weight = (row - before) / (after - before)
+                    data[row] = data[before] * (1 - weight) + data[after] * weight
+
+    scale, offset = np.float32(transform["scale"]), np.float32(transform["offset"])
+    # Blocks follow the memory layout: day rows, or cell columns for a cell-major (memory-mapped) array
+    axis = 1 if data.flags.f_contiguous and not data.flags.c_contiguous else 0
+    step = max(1, block_elements // max(1, data.shape[1 - axis]))
+    for start in range(0, data.shape[axis], step):
+        block = data[start:start + step] if axis == 0 else data[:, start:start + step]
+        if scale != 1:
+            np.multiply(block, scale, out=block)
+        if offset:
+            np.add(block, offset, out=block)
+        if transform["decimals"] is not None:
+            np.round(block, transform["decimals"], out=block)
+        if transform["fill_value"] is not None:
+            block[np.isnan(block)] = transform["fill_value"]
+    return data
 
 
 class ClimateDataDownloader:
@@ -27,33 +816,271 @@ class ClimateDataDownloader:
         self.dates_projected = np.arange(2015, 2101) # projected years from 2015 ~ 2100
         self.max_retries = 3
         self.timeout = 10
+        self.ncss_url = "https://ds.nccs.nasa.gov/thredds/ncss/grid/AMES/NEX"
+        self.grid_res = 0.25 # NEX-GDDP-CMIP6 grid spacing in degrees
+        self.tile_deg = None # split the bounding box into tiles of this size (degrees) for large domains
+        self.tile_workers = 4
+        self.cell_selection = "bbox" # which grid cells to convert: "bbox", "intersects" or "nearest"
+        self.cell_buffer = 0.0 # degrees added around the subbasin polygons in "intersects" mode
+        self._cell_index = {}
+        self.output_suffix = "" # appended to the model name of the output folders, e.g. to separate members
+        self.transforms = {} # per-variable overrides of VARIABLE_TRANSFORMS, e.g. {"hurs": {"scale": 0.01}}
+        self.memory_fraction = 0.8 # share of the available RAM used as the conversion budget when none is given
+        self.out_of_core = False # transpose cell blocks through memory-mapped scratch files instead of RAM
+        self.scratch_dir = None # where out-of-core scratch files go, defaults to {working_dir}/nc2swat_scratch
+        self.output_backend = "directory" # one of OUTPUT_BACKENDS, or a backend instance
+        # Multi-year dataset requested in batch mode; the server must expose an aggregation under this name
+        self.batch_filename = "{var}_day_{model}_{ssp}_{member}_gn_{start}-{end}{vers}.nc"
+        self._no_batch_dataset = False # set by the first 404 on a multi-year request of a download_all run
         self.nworkers = self._core_workers()
 
+    @property
+    def metrics(self):
+        if getattr(self, "_metrics", None) is None:
+            self._metrics = DownloadMetrics(self.working_dir)
+        return self._metrics
+
+    def __getstate__(self):
+        # The metrics queue and writer thread stay in the parent; worker processes do not report to them
+        state = self.__dict__.copy()
+        state.pop("_metrics", None)
+        return state
+
+    def _output(self):
+        if getattr(self, "_output_store", None) is None:
+            backend = self.output_backend
+            self._output_store = OUTPUT_BACKENDS[backend]() if isinstance(backend, str) else backend
+        return self._output_store
+
     def _core_workers(self):
         return psutil.cpu_count(logical=False)
 
-    def _get_bounds(self):
+    def _read_shapefile(self):
         for file in os.listdir(self.working_dir):
             if file.endswith(".shp"):
                 shp_file_path = os.path.join(self.working_dir, file)
                 gdf = gpd.read_file(shp_file_path)
                 gdf = gdf.to_crs(epsg=4326) # Set the CRS to WGS84
-                return gdf.total_bounds
+                return gdf
+
+    def _get_bounds(self):
+        return self._read_shapefile().total_bounds
+
+    def build_cell_index(self, latitudes, longitudes):
+        # Flat (lat-major) indices of the grid cells to convert, built once per grid:
+        #   "bbox"       every cell in the bounding box
+        #   "intersects" cells whose box intersects the subbasin polygons buffered by cell_buffer degrees
+        #   "nearest"    only the cell nearest to each subbasin
+        key = (self.cell_selection, self.cell_buffer, tuple(np.round(latitudes, 4)), tuple(np.round(longitudes, 4)))
+        if key in self._cell_index:
+            return self._cell_index[key]
+
+        if self.cell_selection == "bbox":
+            cell_idx = np.arange(len(latitudes) * len(longitudes))
+        else:
+            nearest = self.subbasin_cells(latitudes, longitudes)['CELL'].to_numpy()
+            if self.cell_selection == "nearest":
+                cell_idx = np.unique(nearest)
+            elif self.cell_selection == "intersects":
+                half = self.grid_res / 2
+                lat_grid, lon_grid = np.meshgrid(np.asarray(latitudes, dtype=float),
+                                                 (np.asarray(longitudes, dtype=float) + 180) % 360 - 180, indexing="ij")
+                boxes = shapely.box(lon_grid.ravel() - half, lat_grid.ravel() - half,
+                                    lon_grid.ravel() + half, lat_grid.ravel() + half)
+                basin = shapely.union_all(self._read_shapefile().geometry.values)
+                if self.cell_buffer:
+                    basin = basin.buffer(self.cell_buffer)
+                # Every subbasin keeps at least its nearest cell, even if it is smaller than one grid cell
+                cell_idx = np.union1d(np.flatnonzero(shapely.intersects(boxes, basin)), nearest)
+            else:
+                raise ValueError(f"unknown cell_selection {self.cell_selection!r}")
+        self._cell_index[key] = cell_idx
+        return cell_idx
+
+    def subbasin_cells(self, latitudes, longitudes):
+        # Nearest grid cell to each subbasin centroid
+        gdf = self._read_shapefile()
+        subbasins = gdf['Subbasin'].to_numpy() if 'Subbasin' in gdf.columns else np.arange(1, len(gdf) + 1)
+        centroids = shapely.centroid(gdf.geometry.values)
+        lat_idx = np.abs(np.asarray(latitudes, dtype=float)[None, :] - shapely.get_y(centroids)[:, None]).argmin(axis=1)
+        lons = (np.asarray(longitudes, dtype=float) + 180) % 360 - 180
+        lon_idx = np.abs(lons[None, :] - shapely.get_x(centroids)[:, None]).argmin(axis=1)
+        lat_lon_str, lat_lon_pairs = self._lat_lon_names(latitudes, longitudes)
+        cells = lat_idx * len(longitudes) + lon_idx
+        return pd.DataFrame({
+            'SUBBASIN': subbasins,
+            'LAT': np.round(shapely.get_y(centroids), 4),
+            'LONG': np.round(shapely.get_x(centroids), 4),
+            'CELL': cells,
+            'NAME': [lat_lon_str[cell] for cell in cells],
+        })
 
     def download_nc_file(self, vers, var, ssp, date, save_folder):
-        filename = f"{var}_day_{self.model_name}_{ssp}_{self.meta_data_format}_gn_{str(date)}{vers}.nc"
+        filename = self._nc_filename(vers, var, ssp, date)
         save_path = os.path.join(save_folder, filename)
 
-        if not os.path.exists(save_path):
-            
-            #NOTE: change start time T12:00:00Z -> T00:00:00Z to get 365 days
-            wget_string = (
-                f"https://ds.nccs.nasa.gov/thredds/ncss/grid/AMES/NEX/{self.dataset_name}/{self.model_name}/{ssp}/"
-                f"{self.meta_data_format}/{var}/{filename}?var={var}&north={self.north}&west={self.west}&east={self.east}&south={self.south}"
-                f"&horizStride=1&time_start={date}-01-01T00:00:00Z"
-                f"&time_end={date}-12-31T12:00:00Z&&&accept=netcdf3&addLatLon=true"
-            )
-            wget.download(wget_string, save_path, bar=None)
+        # A file left behind by an earlier run is only kept if it passes validation
+        if os.path.exists(save_path):
+            if self._record_download(vers, var, ssp, date, save_path):
+                return False
+            os.remove(save_path)
+
+        wget_string = self._subset_url(filename, var, ssp, date)
+        # Download to a temporary file and only move it into place once it validates,
+        # so an interrupted download never leaves a truncated .nc file behind
+        tmp_path = save_path + ".part"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if self.tile_deg:
+            self._download_tiled(filename, var, ssp, date, tmp_path)
+        else:
+            wget.download(wget_string, tmp_path, bar=None)
+        if not self._record_download(vers, var, ssp, date, tmp_path):
+            os.remove(tmp_path)
+            raise ValueError(f"downloaded file for {ssp}, {var}, {date} failed validation")
+        os.replace(tmp_path, save_path)
+        return True
+
+    def _subset_url(self, filename, var, ssp, date, end_date=None, bounds=None):
+        west, south, east, north = bounds if bounds is not None else (self.west, self.south, self.east, self.north)
+        #NOTE: change start time T12:00:00Z -> T00:00:00Z to get 365 days
+        return (
+            f"{self.ncss_url}/{self.dataset_name}/{self.model_name}/{ssp}/"
+            f"{self.meta_data_format}/{var}/{filename}?var={var}&north={north}&west={west}&east={east}&south={south}"
+            f"&horizStride=1&time_start={date}-01-01T00:00:00Z"
+            f"&time_end={end_date or date}-12-31T12:00:00Z&&&accept=netcdf3&addLatLon=true"
+        )
+
+    def _tile_bounds(self):
+        # Tile edges sit on grid lines (multiples of tile_deg, itself a multiple of grid_res), so every cell
+        # centre falls in exactly one tile; edge slivers without any cell centre are dropped. An axis narrower
+        # than a cell, with no centre at all, keeps one tile over its whole range, as the untiled request would
+        tile_deg = max(self.grid_res, round(self.tile_deg / self.grid_res) * self.grid_res)
+
+        def edges(low, high):
+            inner = np.arange(np.floor(low / tile_deg) + 1, np.ceil(high / tile_deg)) * tile_deg
+            bounds = np.concatenate([[low], inner, [high]])
+            first_centre = np.ceil((bounds[:-1] - self.grid_res / 2) / self.grid_res) * self.grid_res + self.grid_res / 2
+            return [(a, b) for a, b, centre in zip(bounds[:-1], bounds[1:], first_centre) if centre <= b] or [(low, high)]
+
+        return [(west, south, east, north)
+                for south, north in edges(self.south, self.north)
+                for west, east in edges(self.west, self.east)]
+
+    def _download_tiled(self, filename, var, ssp, date, tmp_path, end_date=None):
+        tiles = self._tile_bounds()
+        tile_paths = [f"{tmp_path}.tile{i}" for i in range(len(tiles))]
+        try:
+            with ThreadPoolExecutor(max_workers=min(len(tiles), self.tile_workers)) as executor:
+                tasks = [executor.submit(self._download_tile,
+                                         self._subset_url(filename, var, ssp, date, end_date, bounds=bounds), tile_path)
+                         for bounds, tile_path in zip(tiles, tile_paths)]
+                for future in as_completed(tasks):
+                    future.result()
+            with netcdf_lock:
+                _stitch_tiles(tmp_path, tile_paths, var, self.west % 360, self.grid_res)
+        finally:
+            for tile_path in tile_paths:
+                if os.path.exists(tile_path):
+                    os.remove(tile_path)
+
+    def _download_tile(self, url, tile_path):
+        # Gateway timeouts are retried per tile, so one slow tile does not restart the whole grid
+        for attempt in range(self.max_retries):
+            try:
+                wget.download(url, tile_path, bar=None)
+                return
+            except HTTPError as e:
+                if e.code != 504 or attempt == self.max_retries - 1:
+                    raise
+                time.sleep(self.timeout)
+
+    def _nc_filename(self, vers, var, ssp, date):
+        return f"{var}_day_{self.model_name}_{ssp}_{self.meta_data_format}_gn_{str(date)}{vers}.nc"
+
+    def _next_version(self, vers):
+        # Versions are tried from the last (newest) to the first listed in versions_avail
+        idx = self.versions_avail.index(vers)
+        return self.versions_avail[idx - 1] if idx > 0 else None
+
+    def _manifest_path(self):
+        return os.path.join(self.working_dir, "download_manifest.sqlite")
+
+    def _manifest(self):
+        conn = sqlite3.connect(self._manifest_path(), timeout=60)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS downloads ("
+            "dataset TEXT, model TEXT, member TEXT, ssp TEXT, var TEXT, year INTEGER, "
+            "vers TEXT, filename TEXT, nbytes INTEGER, sha256 TEXT, valid INTEGER, message TEXT, checked TEXT, "
+            "PRIMARY KEY (dataset, model, member, ssp, var, year))")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS grids ("
+            "dataset TEXT PRIMARY KEY, nlat INTEGER, nlon INTEGER, lat0 REAL, lon0 REAL)")
+        # Inputs and parameters each converted (ssp, variables) unit of an output folder was last built from
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversions ("
+            "folder TEXT, ssp TEXT, vars TEXT, target TEXT, inputs TEXT, params TEXT, end_date TEXT, converted TEXT, "
+            "PRIMARY KEY (folder, ssp, vars))")
+        return conn
+
+    def _validate_nc(self, file_path, var, year):
+        # Returns (valid, message): the file must open, hold a full year of days and match the reference grid
+        try:
+            with netcdf_lock, nc.Dataset(file_path, mode='r') as data_file:
+                if var not in data_file.variables:
+                    return False, f"variable {var} missing"
+                time_var = data_file.variables['time']
+                calendar = _nc_calendar(time_var)
+                num_days = data_file[var].shape[0]
+                # netCDF3 files are uncompressed, so a truncated download is shorter than its own variable payload
+                if (data_file.data_model.startswith("NETCDF3")
+                        and os.path.getsize(file_path) < data_file[var].size * data_file[var].dtype.itemsize):
+                    return False, "truncated file"
+                if num_days == 0:
+                    return False, "no time steps"
+                data_file[var][-1]  # the last day must decode
+                if num_days != _expected_days(int(year), calendar):
+                    return False, f"{num_days} days, expected {_expected_days(int(year), calendar)} ({calendar})"
+                grid = (len(data_file.variables['lat']), len(data_file.variables['lon']),
+                        round(float(data_file.variables['lat'][0]), 3), round(float(data_file.variables['lon'][0]), 3))
+        except (OSError, RuntimeError, KeyError, IndexError, ValueError) as e:
+            return False, f"unreadable: {e}"
+
+        with _manifest_lock, self._manifest() as conn:
+            row = conn.execute("SELECT nlat, nlon, lat0, lon0 FROM grids WHERE dataset = ?",
+                               (self.dataset_name,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO grids VALUES (?, ?, ?, ?, ?)", (self.dataset_name, *grid))
+            elif tuple(row) != grid:
+                return False, f"grid {grid} does not match {tuple(row)}"
+        return True, "ok"
+
+    def _record_download(self, vers, var, ssp, date, file_path):
+        valid, message = self._validate_nc(file_path, var, date)
+        filename = os.path.basename(file_path).removesuffix(".part")
+        with _manifest_lock, self._manifest() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.dataset_name, self.model_name, self.meta_data_format, ssp, var, int(date), vers, filename,
+                 os.path.getsize(file_path), _sha256(file_path) if valid else None, int(valid), message,
+                 datetime.now().isoformat(timespec='seconds')))
+        return valid
+
+    def _manifest_completed(self):
+        # (ssp, var, year) entries recorded as valid whose file is still on disk with the recorded size
+        if not os.path.exists(self._manifest_path()):
+            return set()
+        with _manifest_lock, self._manifest() as conn:
+            rows = conn.execute(
+                "SELECT ssp, var, year, filename, nbytes FROM downloads "
+                "WHERE dataset = ? AND model = ? AND member = ? AND valid = 1",
+                (self.dataset_name, self.model_name, self.meta_data_format)).fetchall()
+        completed = set()
+        for ssp, var, year, filename, nbytes in rows:
+            file_path = os.path.join(self._var_folder(ssp, var), filename)
+            if os.path.exists(file_path) and os.path.getsize(file_path) == nbytes:
+                completed.add((ssp, var, year))
+        return completed
 
     def download_all_single(self):
         for ssp in self.ssp_of_interest:
@@ -78,26 +1105,49 @@ class ClimateDataDownloader:
                                 time.sleep(self.timeout)
                             else:
                                 # Try the next version
-                                if vers == self.versions_avail[2]:
-                                    vers = self.versions_avail[1]
-                                elif vers == self.versions_avail[1]:
-                                    vers = self.versions_avail[0]
-                                else:
+                                vers = self._next_version(vers)
+                                if vers is None:
                                     print(f"All versions failed to download for {var} on {date}.")
                                     break
+                        except ValueError as e:
+                            # Truncated or inconsistent file: fetch the same version again, as download_with_retries does
+                            print(f"{e} on attempt {attempt + 1} for version {vers}.")
+                    else:
+                        print(f"All attempts failed to download {var} on {date}.")
 
     def _conv_360_180(self, lon):
         newlon = (float(lon) + 180) % 360 - 180
         return f"{newlon:.3f}"
 
 
-    def download_all(self):
+    def _start_download_log(self, resume):
+        self.metrics.flush()
         time = datetime.now().strftime('- %m/%d/%y %H:%M:%S -')
-        if os.path.exists(os.path.join(self.working_dir, "downloadednc.log")):
+        if os.path.exists(os.path.join(self.working_dir, "downloadednc.log")) and not resume:
             os.remove(os.path.join(self.working_dir, "downloadednc.log"))
-        with open(os.path.join(self.working_dir, "downloadednc.log"), "w") as f:
+        with open(os.path.join(self.working_dir, "downloadednc.log"), "a") as f:
             f.write(f"# log files created by nc2swat ... {time}\n")
 
+    def _download_jobs(self, resume):
+        # (var, ssp, date, save_folder) for every file to fetch; in resume mode only entries missing
+        # from the manifest, or recorded as invalid, are fetched again
+        completed = self._manifest_completed() if resume else set()
+        jobs = []
+        for ssp in self.ssp_of_interest:
+            dates = self.dates_historical if ssp == "historical" else self.dates_projected
+
+            for var in self.variables_of_interest:
+                save_folder = f'{self.working_dir}/{self.dataset_name}/{self.model_name}/{ssp}/{self.meta_data_format}/{var}'
+                os.makedirs(save_folder, exist_ok=True)
+
+                for date in dates:
+                    if (ssp, var, int(date)) not in completed:
+                        jobs.append((var, ssp, date, save_folder))
+        return jobs
+
+    def download_all(self, resume=False, batch_target_mb=None):
+        self._start_download_log(resume)
+
         print(
             f"\n > Start downloading dataset in parallel processing"
             + colored(f" with {self.nworkers} workers", 'magenta')
@@ -105,306 +1155,954 @@ class ClimateDataDownloader:
                 " ... initiated", 'blue') + "\n"
                 f"   D: Dataset  | M: Model  | ssp: SSP  | Var: Variable  | Ver: Version  | Date: Date   \n")
         
+        jobs = self._download_jobs(resume)
+        self.metrics.start(len(jobs))
         tasks = []
-        with ThreadPoolExecutor(max_workers=self.nworkers) as executor:  # Adjust max_workers as needed and use number of cores
-            for ssp in self.ssp_of_interest:
-                dates = self.dates_historical if ssp == "historical" else self.dates_projected
-
-                for var in self.variables_of_interest:
-                    save_folder = f'{self.working_dir}/{self.dataset_name}/{self.model_name}/{ssp}/{self.meta_data_format}/{var}'
-                    os.makedirs(save_folder, exist_ok=True)
-
-                    for date in dates:
-                            vers = self.versions_avail[-1]  # Start with the last version
-                            tasks.append(
-                                executor.submit(self.download_with_retries, vers, var, ssp, date, save_folder)
-                            )
+        with self.metrics.stage("download_all", model=self.model_name, files=len(jobs)), \
+                ThreadPoolExecutor(max_workers=self.nworkers) as executor:  # Adjust max_workers as needed and use number of cores
+            if batch_target_mb:
+                self._no_batch_dataset = False
+                # Years already on disk and valid are kept, as download_nc_file does for single-year requests
+                cached = list(executor.map(lambda job: self._keep_existing(self.versions_avail[-1], *job), jobs))
+                jobs = [job for job, keep in zip(jobs, cached) if not keep]
+                for var, ssp, years, save_folder in self._batch_jobs(jobs, batch_target_mb):
+                    tasks.append(executor.submit(self.download_batch, var, ssp, years, save_folder))
+            else:
+                for var, ssp, date, save_folder in jobs:
+                    vers = self.versions_avail[-1]  # Start with the last version
+                    tasks.append(
+                        executor.submit(self.download_with_retries, vers, var, ssp, date, save_folder)
+                    )
 
             for future in as_completed(tasks):
                 try:
                     future.result()
                 except Exception as e: # Raise any exceptions that occurred during download
-                    print(f"Download failed with exception: {e}")
+                    self.metrics.message(f"Download failed with exception: {e}")
+
+    def _keep_existing(self, vers, var, ssp, date, save_folder):
+        # True when the year is already on disk and validates; an invalid file is removed so it is fetched again
+        save_path = os.path.join(save_folder, self._nc_filename(vers, var, ssp, date))
+        if not os.path.exists(save_path):
+            return False
+        if not self._record_download(vers, var, ssp, date, save_path):
+            os.remove(save_path)
+            return False
+        self.metrics.request_started()
+        self.metrics.request(self.model_name, ssp, var, date, vers, "cached", 0.0)
+        self._log_download_ok(vers, var, ssp, date)
+        return True
+
+    def _batch_years(self, batch_target_mb):
+        # Years per request so that a response (float32, up to 366 days per year) stays near the target size
+        nlat = int(np.ceil((self.north - self.south) / self.grid_res)) + 1
+        nlon = int(np.ceil((self.east - self.west) / self.grid_res)) + 1
+        year_bytes = nlat * nlon * 366 * 4
+        return max(1, int(batch_target_mb * 1024 ** 2 // year_bytes))
+
+    def _batch_jobs(self, jobs, batch_target_mb):
+        # Group consecutive years of each (var, ssp) into windows of at most _batch_years years
+        window = self._batch_years(batch_target_mb)
+        batches = []
+        for var, ssp, date, save_folder in jobs:
+            if (batches and batches[-1][:2] == (var, ssp) and len(batches[-1][2]) < window
+                    and batches[-1][2][-1] == int(date) - 1):
+                batches[-1][2].append(int(date))
+            else:
+                batches.append((var, ssp, [int(date)], save_folder))
+        return batches
+
+    def download_batch(self, var, ssp, years, save_folder):
+        # A failed window is split in half until single years remain, which go through download_with_retries;
+        # a 404 means the server has no multi-year dataset, so every window of the run falls back to single years
+        vers = self.versions_avail[-1]
+        windows = [years]
+        while windows:
+            window = windows.pop(0)
+            if len(window) > 1 and not self._no_batch_dataset:
+                self.metrics.request_started()
+                start = time.perf_counter()
+                try:
+                    nbytes = self.download_nc_window(vers, var, ssp, window, save_folder)
+                    self.metrics.request(self.model_name, ssp, var, window[0], vers, 200, time.perf_counter() - start,
+                                         nbytes, end_year=window[-1])
+                    for date in window:
+                        self._log_download_ok(vers, var, ssp, date)
+                    continue
+                except HTTPError as e:
+                    self.metrics.request(self.model_name, ssp, var, window[0], vers, e.code,
+                                         time.perf_counter() - start, end_year=window[-1])
+                    if e.code == 404:
+                        if not self._no_batch_dataset:
+                            self._no_batch_dataset = True
+                            self.metrics.message(f"  ... no multi-year dataset for {self.dataset_name} on the server"
+                                                 + colored(" ... single-year requests", 'yellow'))
+                        windows = [window] + windows
+                        continue
+                    self.metrics.message(f"  ... HTTP {e.code} for {ssp}, {var}, {window[0]}-{window[-1]}. Splitting the request...")
+                except ValueError as e:
+                    self.metrics.request(self.model_name, ssp, var, window[0], vers, "invalid",
+                                         time.perf_counter() - start, end_year=window[-1])
+                    self.metrics.message(f"  ... {e}. Splitting the request...")
+                except Exception:
+                    self.metrics.request(self.model_name, ssp, var, window[0], vers, "error",
+                                         time.perf_counter() - start, end_year=window[-1])
+                    raise
+                half = len(window) // 2
+                windows = [window[:half], window[half:]] + windows
+            else:
+                for date in window:
+                    self.download_with_retries(vers, var, ssp, date, save_folder)
+
+    def download_nc_window(self, vers, var, ssp, years, save_folder):
+        # One request for several years, split into the per-year files process_netcdf expects; returns the
+        # size of the response
+        filename = self.batch_filename.format(var=var, model=self.model_name, ssp=ssp, member=self.meta_data_format,
+                                              start=years[0], end=years[-1], vers=vers)
+        batch_path = os.path.join(save_folder, filename + ".part")
+        if os.path.exists(batch_path):
+            os.remove(batch_path)
+        if self.tile_deg:
+            self._download_tiled(filename, var, ssp, years[0], batch_path, years[-1])
+        else:
+            wget.download(self._subset_url(filename, var, ssp, years[0], years[-1]), batch_path, bar=None)
+        nbytes = os.path.getsize(batch_path)
+
+        try:
+            with netcdf_lock, nc.Dataset(batch_path, mode='r') as data_file:
+                time_var = data_file.variables['time']
+                calendar = _nc_calendar(time_var)
+                file_years = np.array([date.year for date in nc.num2date(time_var[:], units=time_var.units,
+                                                                          calendar=calendar)])
+                for date in years:
+                    save_path = os.path.join(save_folder, self._nc_filename(vers, var, ssp, date))
+                    _write_nc_subset(save_path + ".part", data_file, var, np.flatnonzero(file_years == date))
+                    if not self._record_download(vers, var, ssp, date, save_path + ".part"):
+                        os.remove(save_path + ".part")
+                        raise ValueError(f"{ssp}, {var}, {date} from batch {years[0]}-{years[-1]} failed validation")
+                    os.replace(save_path + ".part", save_path)
+        except OSError as e:
+            raise ValueError(f"unreadable batch {years[0]}-{years[-1]} for {ssp}, {var}: {e}")
+        finally:
+            os.remove(batch_path)
+        return nbytes
 
     def download_with_retries(self, vers, var, ssp, date, save_folder):
+        # True once the file is on disk; False after it was logged as failed
         for attempt in range(self.max_retries):
+            self.metrics.request_started()
+            start = time.perf_counter()
             try:
-                self.download_nc_file(vers, var, ssp, date, save_folder)
-                print(f"  ... D: {self.dataset_name}, M: {self.model_name}, " +
-                      f"ssp: {ssp}, Var: {var}, Ver: {vers}, Date:{date}" + colored(" ... OK", 'green'))
-                self.write_ok_log_file(ssp, var, date)
-                return
+                fetched = self.download_nc_file(vers, var, ssp, date, save_folder)
+                nbytes = os.path.getsize(os.path.join(save_folder, self._nc_filename(vers, var, ssp, date)))
+                self.metrics.request(self.model_name, ssp, var, date, vers, 200 if fetched else "cached",
+                                     time.perf_counter() - start, nbytes if fetched else 0, attempt + 1)
+                self._log_download_ok(vers, var, ssp, date, attempt)
+                return True
             except HTTPError as e:
+                self.metrics.request(self.model_name, ssp, var, date, vers, e.code, time.perf_counter() - start,
+                                     attempt=attempt + 1)
                 if e.code == 504 and attempt < self.max_retries - 1:
-                    print(
+                    self.metrics.message(
                         f"  ... Gateway Timeout (504) on attempt {attempt + 1} for version {vers}. Retrying in {self.timeout} seconds...")
                     time.sleep(self.timeout)
                 else:
                     # Try the next version
-                    if vers == self.versions_avail[2]:
-                        vers = self.versions_avail[1]
-                    elif vers == self.versions_avail[1]:
-                        vers = self.versions_avail[0]
-                    else:
-                        print(f"  ... All versions for {ssp} failed to download for {var} on {date}" + colored(" ... failed", 'red'))
-                        self.write_failed_log_file(ssp, var, date)
-                        return
+                    vers = self._next_version(vers)
+                    if vers is None:
+                        break
+            except ValueError as e:
+                self.metrics.request(self.model_name, ssp, var, date, vers, "invalid", time.perf_counter() - start,
+                                     attempt=attempt + 1)
+                # Truncated or inconsistent file: fetch the same version again
+                if attempt < self.max_retries - 1:
+                    self.metrics.message(f"  ... {e} on attempt {attempt + 1} for version {vers}. Retrying...")
+                else:
+                    self._log_download_failed(ssp, var, date, attempt, "{ssp} failed validation")
+                    return False
+            except Exception:
+                self.metrics.request(self.model_name, ssp, var, date, vers, "error", time.perf_counter() - start,
+                                     attempt=attempt + 1)
+                raise
+        # Out of versions, or out of attempts while older versions were left untried
+        self._log_download_failed(ssp, var, date, self.max_retries - 1, "All versions for {ssp} failed to download")
+        return False
 
-                    
-    def process_netcdf(self):
+    def download_all_async(self, resume=False, max_concurrency=64, initial_concurrency=None,
+                           request_timeout=600, max_backoff=120):
+        if aiohttp is None:
+            raise ImportError("download_all_async requires aiohttp (pip install aiohttp)")
+        self._start_download_log(resume)
+        jobs = self._download_jobs(resume)
+        initial_concurrency = initial_concurrency or min(max_concurrency, 2 * self.nworkers)
+        print(
+            f"\n > Start downloading dataset asynchronously"
+            + colored(f" with up to {max_concurrency} connections", 'magenta')
+            + colored(
+                " ... initiated", 'blue') + "\n"
+                f"   D: Dataset  | M: Model  | ssp: SSP  | Var: Variable  | Ver: Version  | Date: Date   \n")
+        self.metrics.start(len(jobs))
+        with self.metrics.stage("download_all_async", model=self.model_name, files=len(jobs)):
+            asyncio.run(self._download_jobs_async(jobs, max_concurrency, initial_concurrency,
+                                                  request_timeout, max_backoff))
+
+    async def _download_jobs_async(self, jobs, max_concurrency, initial_concurrency, request_timeout, max_backoff):
+        limiter = _AdaptiveLimiter(initial_concurrency, maximum=max_concurrency)
+        connector = aiohttp.TCPConnector(limit=max_concurrency, limit_per_host=max_concurrency)
+        timeout = aiohttp.ClientTimeout(total=request_timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            results = await asyncio.gather(
+                *[self._download_async(session, limiter, var, ssp, date, save_folder, max_backoff)
+                  for var, ssp, date, save_folder in jobs],
+                return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.metrics.message(f"Download failed with exception: {result}")
+
+    async def _download_async(self, session, limiter, var, ssp, date, save_folder, max_backoff):
+        # Same version fallback as download_with_retries: 504s are retried on the same version
+        # (with exponential backoff and jitter), any other HTTP error moves on to the next version
+        vers = self.versions_avail[-1]
+        for attempt in range(self.max_retries):
+            save_path = os.path.join(save_folder, self._nc_filename(vers, var, ssp, date))
+            if os.path.exists(save_path):
+                if await asyncio.to_thread(self._record_download, vers, var, ssp, date, save_path):
+                    self._log_download_ok(vers, var, ssp, date)
+                    return
+                os.remove(save_path)
+
+            request_info = (ssp, var, date, vers, attempt + 1)
+            if self.tile_deg:
+                status = await self._fetch_tiled_async(session, limiter, os.path.basename(save_path), var, ssp, date,
+                                                       save_path + ".part", request_info)
+            else:
+                status = await self._fetch_async(session, limiter, self._subset_url(
+                    os.path.basename(save_path), var, ssp, date), save_path + ".part", request_info)
+            if status == 200:
+                if await asyncio.to_thread(self._record_download, vers, var, ssp, date, save_path + ".part"):
+                    os.replace(save_path + ".part", save_path)
+                    self._log_download_ok(vers, var, ssp, date, attempt)
+                    return
+                os.remove(save_path + ".part")
+                self.metrics.message(f"  ... downloaded file for {ssp}, {var}, {date} failed validation on attempt {attempt + 1}. Retrying...")
+            elif (status is None or status >= 500) and attempt < self.max_retries - 1:
+                delay = min(max_backoff, self.timeout * 2 ** attempt) * random.uniform(0.5, 1.5)
+                self.metrics.message(
+                    f"  ... HTTP {status or 'error'} on attempt {attempt + 1} for version {vers}. Retrying in {delay:.0f} seconds...")
+                await asyncio.sleep(delay)
+            else:
+                # Try the next version
+                vers = self._next_version(vers)
+                if vers is None:
+                    break
+        self._log_download_failed(ssp, var, date, self.max_retries - 1, "All versions for {ssp} failed to download")
+
+    async def _fetch_tiled_async(self, session, limiter, filename, var, ssp, date, tmp_path, request_info):
+        # The tiles of a tile_deg split are fetched concurrently through the same limiter and stitched into tmp_path;
+        # returns 200 when every tile arrived, otherwise the first failing status (None for a connection error)
+        tiles = self._tile_bounds()
+        tile_paths = [f"{tmp_path}.tile{i}" for i in range(len(tiles))]
+
+        def stitch():
+            with netcdf_lock:
+                _stitch_tiles(tmp_path, tile_paths, var, self.west % 360, self.grid_res)
+
+        try:
+            statuses = await asyncio.gather(*[
+                self._fetch_async(session, limiter, self._subset_url(filename, var, ssp, date, bounds=bounds),
+                                  tile_path, request_info)
+                for bounds, tile_path in zip(tiles, tile_paths)])
+            failed = [status for status in statuses if status != 200]
+            if failed:
+                return failed[0]
+            await asyncio.to_thread(stitch)
+            return 200
+        except ValueError as e:
+            self.metrics.message(f"  ... tiles for {ssp}, {var}, {date} could not be stitched: {e}")
+            return None
+        finally:
+            for tile_path in tile_paths:
+                if os.path.exists(tile_path):
+                    os.remove(tile_path)
+
+    async def _fetch_async(self, session, limiter, url, tmp_path, request_info, chunk_size=1024 ** 2):
+        # Stream the response body straight to disk; returns the HTTP status, or None on a connection error
+        ssp, var, date, vers, attempt = request_info
+        await limiter.acquire()
+        self.metrics.request_started()
+        start = time.perf_counter()
+        status = None
+        nbytes = 0
+        try:
+            async with session.get(url) as response:
+                status = response.status
+                if status == 200:
+                    with open(tmp_path, "wb") as f:
+                        async for chunk in response.content.iter_chunked(chunk_size):
+                            f.write(chunk)
+                            nbytes += len(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.metrics.message(f"  ... request failed: {e!r}")
+            status = None
+        finally:
+            latency = time.perf_counter() - start
+            self.metrics.request(self.model_name, ssp, var, date, vers, status or "error", latency, nbytes, attempt)
+            await limiter.release(latency if status == 200 else None, status is None or status >= 500)
+        return status
+
+    def _log_download_ok(self, vers, var, ssp, date, retries=0):
+        self.metrics.message(f"  ... D: {self.dataset_name}, M: {self.model_name}, " +
+                             f"ssp: {ssp}, Var: {var}, Ver: {vers}, Date:{date}" + colored(" ... OK", 'green'))
+        self.metrics.file(self.model_name, ssp, var, date, vers, True, retries)
+        self.write_ok_log_file(ssp, var, date)
+
+    def _log_download_failed(self, ssp, var, date, retries, reason):
+        self.metrics.message(f"  ... {reason.format(ssp=ssp)} for {var} on {date}" + colored(" ... failed", 'red'))
+        self.metrics.file(self.model_name, ssp, var, date, None, False, retries)
+        self.write_failed_log_file(ssp, var, date)
+
+    def _nc_files(self, climate_info_path):
+        return [os.path.join(climate_info_path, data_file_nm)
+                for data_file_nm in sorted(os.listdir(climate_info_path)) if data_file_nm.endswith(".nc")]
+
+    def _lat_lon_names(self, latitudes, longitudes):
+        # Create a list of lat-lon pair names for the columns
+        lat_lon_str = []
+        lat_lon_pairs = []
+        for lat in latitudes:
+            for lon in longitudes:
+                lat_lon_str.append(
+                    f"{int(lat * 1000)}_{int(float(self._conv_360_180(lon)) * 1000)}"
+                    )
+                lat_lon_pairs.append([f"{float(lat):.3f}", f"{float(self._conv_360_180(lon)):.3f}"])
+        return lat_lon_str, lat_lon_pairs
+
+    def _grid_cells(self, latitudes, longitudes):
+        cell_idx = self.build_cell_index(latitudes, longitudes)
+        lat_lon_str, lat_lon_pairs = self._lat_lon_names(latitudes, longitudes)
+        return cell_idx, [lat_lon_str[i] for i in cell_idx], [lat_lon_pairs[i] for i in cell_idx]
+
+    def _read_nc_headers(self, nc_files, var):
+        # Only the dimensions are read here so the output array can be sized before any data is decoded
+        day_counts = []
+        latitudes = longitudes = None
+        for data_file_pth in nc_files:
+            with nc.Dataset(data_file_pth, mode='r') as data_file:
+                day_counts.append(data_file[var].shape[0])
+                if latitudes is None:
+                    latitudes = data_file.variables['lat'][:]
+                    longitudes = data_file.variables['lon'][:]
+        return day_counts, latitudes, longitudes
+
+    def iter_netcdf(self, ssps=None, variables=None, dtype=np.float32):
+        # Yield (ssp, var, time_dates, data, lat_lon_str, lat_lon_pairs) one variable at a time,
+        # so peak memory is bounded by a single (days x cells) array. Variables are decoded by the same reader
+        # as the conversions: a continuous daily axis, with NaN rows for days no file holds
         data_dir = os.path.join(self.working_dir, f"{self.dataset_name}/{self.model_name}")
         if not os.path.isdir(data_dir):
             os.makedirs(data_dir)
-        data_dict_hist = {}
-        data_dict_ssp = {}
         for ssp in sorted(os.listdir(data_dir)):
+            if ssps is not None and ssp not in ssps:
+                continue
             metadata_pth = os.path.join(data_dir, ssp)
-            data_dict_proj = {}
             for metadata_info in sorted(os.listdir(metadata_pth)):
                 var_path = os.path.join(metadata_pth, metadata_info)
 
                 for var in sorted(os.listdir(var_path)):
-                    climate_info_path = os.path.join(var_path, var)
-                    df = pd.DataFrame()
-                    first_time = True
-                    for data_file_nm in sorted(os.listdir(climate_info_path)):
-                        # print(data_file_nm)
-                        data_file_pth = os.path.join(climate_info_path, data_file_nm)
-                        data_file = nc.Dataset(data_file_pth, mode='r')
-                        num_days = data_file[var].shape[0]
-                        var_data = data_file[var][:].reshape(num_days, -1)
-                        latitudes = data_file.variables['lat'][:]
-                        longitudes = data_file.variables['lon'][:]
-
-                        # Get the time variable
-                        time_var = data_file.variables['time']
-                        # Get the time units and calendar attributes
-                        time_units = time_var.units
-                        calendar = time_var.calendar if hasattr(time_var, 'calendar') else 'standard'# convert time
-
-                        # Convert time values to datetime objects
-                        time_dates = nc.num2date(time_var[:], units=time_units, calendar=calendar)
-
-                        # Create a list of lat-lon pair names for the columns
-                        lat_lon_str = []
-                        lat_lon_pairs = []
-                        for lat in latitudes:
-                            for lon in longitudes:
-                                lat_lon_str.append(
-                                    f"{int(lat * 1000)}_{int(float(self._conv_360_180(lon)) * 1000)}"
-                                    )
-                                lat_lon_pairs.append([f"{float(lat):.3f}", f"{float(self._conv_360_180(lon)):.3f}"])
-                        if first_time:
-                            df = pd.DataFrame(var_data, columns=lat_lon_str)
-                            df['time'] = time_dates
-                            df.set_index('time', inplace=True)
-                            first_time = False
-                        else:
-                            temp_df = pd.DataFrame(var_data, columns=lat_lon_str)
-                            temp_df['time'] = time_dates
-                            temp_df.set_index('time', inplace=True)
-                            df = pd.concat([df, temp_df])
-                        data_file.close()
-
-                    if ssp == "historical":
-                        data_dict_hist[var] = df
-                    else:
-                        data_dict_proj[var] = df
-            if not ssp == "historical":
-                data_dict_ssp[ssp] = data_dict_proj
+                    if variables is not None and var not in variables:
+                        continue
+                    nc_files = self._nc_files(os.path.join(var_path, var))
+                    if not nc_files:
+                        continue
+                    time_dates, data, lat_lon_str, missing_rows = self._read_daily_series(nc_files, var)
+                    data[missing_rows] = np.nan
+                    _, latitudes, longitudes = self._read_nc_headers(nc_files[:1], var)
+                    lat_lon_pairs = self._grid_cells(latitudes, longitudes)[2]
+                    yield ssp, var, time_dates, data.astype(dtype, copy=False), lat_lon_str, lat_lon_pairs
+                    del time_dates, data  # release before the next variable is allocated
+
+    def process_netcdf(self):
+        data_dict_hist = {}
+        data_dict_ssp = {}
+        lat_lon_pairs = []
+        for ssp, var, time_dates, data, lat_lon_str, lat_lon_pairs in self.iter_netcdf():
+            df = pd.DataFrame(data, columns=lat_lon_str, index=pd.Index(time_dates, name='time'))
+            if ssp == "historical":
+                data_dict_hist[var] = df
+            else:
+                data_dict_ssp.setdefault(ssp, {})[var] = df
         return data_dict_ssp, data_dict_hist, lat_lon_pairs
 
-    def convert_to_swat(self):
+    def _store_path(self, ssp, var):
+        return os.path.join(self.working_dir, f"{self.model_name}_store", ssp, self.meta_data_format, var)
+
+    def consolidate(self, ssps=None, variables=None):
+        # One-time conversion of the yearly time-major files into one cell-major (cells x days) float32 array
+        # per (ssp, var), so each cell's full record is contiguous on disk and can be memory-mapped
+        print(
+            f"\n > Start consolidating netcdf into a cell-major store"
+            + colored(
+                " ... initiated", 'blue') + "\n")
+        data_dir = os.path.join(self.working_dir, f"{self.dataset_name}/{self.model_name}")
+        for ssp in sorted(os.listdir(data_dir)):
+            if ssps is not None and ssp not in ssps:
+                continue
+            var_path = os.path.join(data_dir, ssp, self.meta_data_format)
+            if not os.path.isdir(var_path):
+                continue
+            for var in sorted(os.listdir(var_path)):
+                if variables is not None and var not in variables:
+                    continue
+                nc_files = self._nc_files(self._var_folder(ssp, var))
+                if nc_files:
+                    with self.metrics.stage("consolidate_var", model=self.model_name, ssp=ssp, var=var,
+                                            files=len(nc_files)):
+                        self._consolidate_var(ssp, var, nc_files)
+                    print(f"  ... ssp: {ssp}, Var: {var}, Files: {len(nc_files)}" + colored(" ... OK", 'green'))
+        _open_store.cache_clear()
+
+    def _consolidate_var(self, ssp, var, nc_files):
+        store_path = self._store_path(ssp, var)
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        day_counts, latitudes, longitudes = self._read_nc_headers(nc_files, var)
+        ncells = len(latitudes) * len(longitudes)
+
+        # Fill the memory-mapped array one yearly file at a time; each year lands as one contiguous run per cell
+        data = np.lib.format.open_memmap(store_path + ".npy.tmp", mode='w+', dtype=np.float32,
+                                         shape=(ncells, sum(day_counts)))
+        dates = np.empty(sum(day_counts), dtype='datetime64[D]')
+        row = 0
+        for data_file_pth, num_days in zip(nc_files, day_counts):
+            with nc.Dataset(data_file_pth, mode='r') as data_file:
+                _decode_nc_rows(data_file[var], data[:, row:row + num_days].T)
+                time_var = data_file.variables['time']
+                calendar = _nc_calendar(time_var)
+                time_dates = nc.num2date(time_var[:], units=time_var.units, calendar=calendar)
+                dates[row:row + num_days] = [str(date)[:10] for date in time_dates]
+            row += num_days
+        data.flush()
+        del data
+
+        np.save(store_path + ".time.npy", dates)
+        with open(store_path + ".json", "w") as f:
+            json.dump({
+                "var": var,
+                "ssp": ssp,
+                "lat": [float(lat) for lat in latitudes],
+                "lon": [float(self._conv_360_180(lon)) for lon in longitudes],
+                "files": [os.path.basename(data_file_pth) for data_file_pth in nc_files],
+            }, f)
+        os.replace(store_path + ".npy.tmp", store_path + ".npy")
+
+    def get_series(self, var, ssp, lat, lon, start=None, end=None):
+        # Read one cell's record from the consolidated store; projected scenarios are prefixed with the historical run
+        parts = [ssp] if ssp == "historical" else ["historical", ssp]
+        series = []
+        for part in parts:
+            store_path = self._store_path(part, var)
+            if not os.path.exists(store_path + ".npy"):
+                if part == "historical" and ssp != "historical":
+                    continue
+                raise FileNotFoundError(f"No consolidated store for {part}, {var}; run consolidate() first")
+            data, dates, meta = _open_store(store_path)
+            lat_dist = np.abs(np.asarray(meta["lat"]) - lat)
+            lon_dist = np.abs((np.asarray(meta["lon"]) - float(lon) + 180) % 360 - 180)
+            lat_idx, lon_idx = int(lat_dist.argmin()), int(lon_dist.argmin())
+            # A point more than half a grid step outside the stored axes has no cell, rather than the edge cell
+            half_step = [np.median(np.diff(meta[axis])) / 2 if len(meta[axis]) > 1 else self.grid_res / 2
+                         for axis in ["lat", "lon"]]
+            if lat_dist[lat_idx] > half_step[0] + 1e-6 or lon_dist[lon_idx] > half_step[1] + 1e-6:
+                raise ValueError(f"({lat}, {lon}) is outside the consolidated grid of {part}, {var}: "
+                                 f"lat {meta['lat'][0]:.3f}..{meta['lat'][-1]:.3f}, "
+                                 f"lon {meta['lon'][0]:.3f}..{meta['lon'][-1]:.3f}")
+            first = 0 if start is None else np.searchsorted(dates, np.datetime64(start, 'D'))
+            last = len(dates) if end is None else np.searchsorted(dates, np.datetime64(end, 'D'), side='right')
+            cell = lat_idx * len(meta["lon"]) + lon_idx
+            series.append(pd.Series(np.array(data[cell, first:last]), index=pd.DatetimeIndex(dates[first:last]),
+                                    name=f"{var}_{meta['lat'][lat_idx]:.3f}_{meta['lon'][lon_idx]:.3f}"))
+        return pd.concat(series) if len(series) > 1 else series[0]
+
+    def write_swat_stations(self, values, file_paths, date_string, paired_values=None, parallel=False):
+        values = np.asarray(values, dtype=np.float32)
+        if paired_values is not None:
+            paired_values = np.asarray(paired_values, dtype=np.float32)
+        output = self._output()
+        if not parallel or not output.concurrent or self.nworkers <= 1 or len(file_paths) < 2 * self.nworkers:
+            _write_station_block(file_paths, date_string, values, paired_values, output=output)
+            return
+
+        # Spread the cells across worker processes, each formatting and writing its own slice
+        bounds = np.linspace(0, len(file_paths), self.nworkers + 1).astype(int)
+        with ProcessPoolExecutor(max_workers=self.nworkers) as executor:
+            tasks = [
+                executor.submit(_write_station_part, output, file_paths[start:stop], date_string,
+                                np.ascontiguousarray(values[:, start:stop]),
+                                None if paired_values is None else np.ascontiguousarray(paired_values[:, start:stop]))
+                for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start
+            ]
+            for future in as_completed(tasks):
+                future.result()
+
+    def _var_folder(self, ssp, var):
+        return f'{self.working_dir}/{self.dataset_name}/{self.model_name}/{ssp}/{self.meta_data_format}/{var}'
+
+    def _swat_folder(self):
+        return f'{self.working_dir}/{self.model_name}{self.output_suffix}_SWAT_files'
+
+    def _swat_units(self):
+        # Independent (ssp, variables) conversion units; tasmax and tasmin share one file per cell
+        data_dir = os.path.join(self.working_dir, f"{self.dataset_name}/{self.model_name}")
+        hist_path = os.path.join(data_dir, "historical", self.meta_data_format)
+        if not os.path.isdir(hist_path):
+            return []
+        hist_vars = [var for var in sorted(os.listdir(hist_path)) if self._nc_files(self._var_folder("historical", var))]
+        units = []
+        for ssp in sorted(os.listdir(data_dir)):
+            if ssp == "historical":
+                continue
+            ssp_vars = [var for var in hist_vars if os.path.isdir(self._var_folder(ssp, var))]
+            if "tasmax" in ssp_vars and "tasmin" in ssp_vars:
+                units.append((ssp, ("tasmax", "tasmin")))
+            units.extend((ssp, (var,)) for var in ssp_vars if var not in ["tasmax", "tasmin"])
+        return units
+
+    def _swat_prefix(self, variables):
+        return "temp_max_min" if variables == ("tasmax", "tasmin") else variables[0]
+
+    def _unit_cells(self, variables):
+        # Station (lat_lon) names and coordinates of a unit, from the header of its first historical file
+        nc_files = self._nc_files(self._var_folder("historical", variables[0]))
+        _, latitudes, longitudes = self._read_nc_headers(nc_files[:1], variables[0])
+        _, lat_lon_str, lat_lon_pairs = self._grid_cells(latitudes, longitudes)
+        return lat_lon_str, lat_lon_pairs
+
+    def _write_swat_index(self, save_folder, variables):
+        lat_lon_str, lat_lon_pairs = self._unit_cells(variables)
+        # Station files are named NAME.txt in the scenario folders (NNN/NAME.txt with the sharded backend)
+        names = [self._output().station_name(f"{self._swat_prefix(variables)}_{item}.txt")[:-len(".txt")]
+                 for item in lat_lon_str]
+
+        ids = list(range(1, len(names) + 1))
+        elevation = [100] * len(names)
+        df_info = pd.DataFrame({
+            'ID': ids,
+            'NAME': names,
+            'LAT': [lat for lat, lon in lat_lon_pairs],
+            'LONG': [self._conv_360_180(lon) for lat, lon in lat_lon_pairs],
+            'ELEVATION': elevation
+        })
+        self._output().write(os.path.join(save_folder, self._swat_prefix(variables) + ".txt"),
+                             df_info.to_csv(index=False, lineterminator='\n')) # write
+
+    def _write_swat_indexes(self, save_folder, units):
+        for variables in sorted({variables for ssp, variables in units}):
+            self._write_swat_index(save_folder, variables)
+
+        if self.cell_selection != "bbox" and units:
+            # Map each subbasin to its nearest station, by the lat_lon suffix of the station names
+            var = units[0][1][0]
+            nc_files = self._nc_files(self._var_folder("historical", var))
+            _, latitudes, longitudes = self._read_nc_headers(nc_files[:1], var)
+            df_cells = self.subbasin_cells(latitudes, longitudes)
+            self._output().write(os.path.join(save_folder, "subbasin_cells.csv"),
+                                 df_cells.drop(columns='CELL').to_csv(index=False, lineterminator='\n'))
+
+    def _transform(self, var):
+        return {**TRANSFORM_DEFAULTS, **VARIABLE_TRANSFORMS.get(var, {}), **self.transforms.get(var, {})}
+
+    def _scratch_dir(self):
+        scratch_dir = self.scratch_dir or os.path.join(self.working_dir, "nc2swat_scratch")
+        os.makedirs(scratch_dir, exist_ok=True)
+        return scratch_dir
+
+    def _cell_chunks(self, variables, chunk_cells):
+        # Selected cells grouped into lat/lon tiles of at most chunk_cells cells (whole latitude rows when a row
+        # fits, otherwise runs of longitudes), so every chunk reads one compact rectangle of each yearly file
+        nc_files = self._nc_files(self._var_folder("historical", variables[0]))
+        _, latitudes, longitudes = self._read_nc_headers(nc_files[:1], variables[0])
+        cell_idx = np.asarray(self.build_cell_index(latitudes, longitudes))
+        if chunk_cells >= len(cell_idx):
+            return [None]
+        nlon = len(longitudes)
+        cols = min(nlon, chunk_cells)
+        rows = max(1, chunk_cells // cols)
+        tiles = (cell_idx // nlon // rows) * (nlon // cols + 1) + (cell_idx % nlon) // cols
+        order = np.argsort(tiles, kind='stable')
+        return np.split(order, np.flatnonzero(np.diff(tiles[order])) + 1)
+
+    def _read_daily_series(self, nc_files, var, start=None, cells=None, scratch=None, decode_bytes=64 * 1024 ** 2):
+        # Lay the files out on a continuous daily axis in one float32 array, decoding contiguous runs of days
+        # straight into their rows; days that no file holds are flagged in missing_rows. cells (positions in
+        # the selected cells) limits the read to the lat/lon rectangle holding them. With a scratch list the
+        # array is a cell-major memory-mapped scratch file (its path is appended to the list), so each cell's
+        # record is contiguous on disk and the yearly files are transposed out of core
+        file_dates = []
+        for data_file_pth in nc_files:
+            with nc.Dataset(data_file_pth, mode='r') as data_file:
+                time_var = data_file.variables['time']
+                calendar = _nc_calendar(time_var)
+                time_dates = nc.num2date(time_var[:], units=time_var.units, calendar=calendar)
+                file_dates.append(pd.to_datetime(pd.Index(time_dates).astype(str)))
+        _, latitudes, longitudes = self._read_nc_headers(nc_files[:1], var)
+        cell_idx, lat_lon_str, lat_lon_pairs = self._grid_cells(latitudes, longitudes)
+        cell_idx = np.asarray(cell_idx)
+        if cells is not None:
+            cell_idx, lat_lon_str = cell_idx[cells], [lat_lon_str[i] for i in np.arange(len(lat_lon_str))[cells]]
+        lat_idx, lon_idx = cell_idx // len(longitudes), cell_idx % len(longitudes)
+        lat_rows, lon_cols = slice(lat_idx.min(), lat_idx.max() + 1), slice(lon_idx.min(), lon_idx.max() + 1)
+        width = lon_cols.stop - lon_cols.start
+        cell_idx = (lat_idx - lat_rows.start) * width + lon_idx - lon_cols.start
+        if len(cell_idx) == (lat_rows.stop - lat_rows.start) * width:
+            cell_idx = slice(None)  # every cell of the rectangle selected, avoid a fancy-indexing copy
+
+        dates = pd.date_range(start=min(days.min() for days in file_dates) if start is None else start,
+                              end=max(days.max() for days in file_dates), freq='D')
+        if scratch is None:
+            data = np.empty((len(dates), len(lat_lon_str)), dtype=np.float32)
+        else:
+            fd, scratch_path = tempfile.mkstemp(suffix=f"_{var}.f32", dir=self._scratch_dir())
+            os.close(fd)
+            scratch.append(scratch_path)
+            data = np.memmap(scratch_path, dtype=np.float32, mode='w+', shape=(len(lat_lon_str), len(dates))).T
+        missing_rows = np.ones(len(dates), dtype=bool)
+        # Each read covers at most decode_bytes of the rectangle, whatever the grid size
+        max_days = max(1, decode_bytes // (4 * (lat_rows.stop - lat_rows.start) * width))
+        for data_file_pth, days in zip(nc_files, file_dates):
+            rows = dates.get_indexer(days)
+            idx = np.flatnonzero(rows >= 0)
+            with nc.Dataset(data_file_pth, mode='r') as data_file:
+                for run in np.split(idx, np.flatnonzero((np.diff(rows[idx]) != 1) | (np.diff(idx) != 1)) + 1):
+                    for first in range(0, len(run), max_days):
+                        part = run[first:first + max_days]
+                        target = slice(rows[part[0]], rows[part[0]] + len(part))
+                        _decode_nc_rows(data_file[var], data[target], part[0], part[-1] + 1, cell_idx,
+                                        lat_rows, lon_cols)
+                        missing_rows[target] = False
+        return dates, data, lat_lon_str, missing_rows
+
+    def _read_swat_series(self, ssp, var, nc_files=None, start=None, cells=None, scratch=None, report=True):
+        # Historical and projected years are read straight into one array and converted in place,
+        # so the frame wraps the only copy of the data; start extends the daily range back to the
+        # day after already converted data
+        if nc_files is None:
+            nc_files = self._nc_files(self._var_folder("historical", var)) + self._nc_files(self._var_folder(ssp, var))
+        dates, data, lat_lon_str, missing_rows = self._read_daily_series(nc_files, var, start, cells, scratch)
+        transform = self._transform(var)
+        _apply_transform(data, missing_rows, transform)
+        for date in dates[missing_rows] if report else []:
+            if transform["missing_days"] == "interpolate":
+                print(f" ... interpolated missing value for {ssp}, {var}, {date.date()}" + colored(" ... missing", 'yellow'))
+            else:
+                print(
+                    f" ... replaced missing value for {ssp}, {var}, {date.date()} with {transform['fill_value']}"
+                    + colored(" ... missing", 'yellow'))
+        return pd.DataFrame(data, columns=lat_lon_str, index=dates, copy=False)
+
+    def _unit_inputs(self, ssp, variables):
+        # The yearly files a unit is built from, in read order, identified by size and modification time
+        inputs = {}
+        for var in variables:
+            inputs[var] = [[part, os.path.basename(file_path), os.path.getsize(file_path),
+                            os.stat(file_path).st_mtime_ns]
+                           for part in ["historical", ssp] for file_path in self._nc_files(self._var_folder(part, var))]
+        return inputs
+
+    def _unit_params(self, writer, variables):
+        return json.dumps({
+            "target": writer.name,
+            "transforms": {var: self._transform(var) for var in variables},
+            "cell_selection": self.cell_selection,
+            "cell_buffer": self.cell_buffer,
+            "bounds": [float(bound) for bound in (self.west, self.south, self.east, self.north)],
+        }, sort_keys=True)
+
+    def _conversion_record(self, writer, ssp, variables):
+        with _manifest_lock, self._manifest() as conn:
+            row = conn.execute("SELECT inputs, params, end_date FROM conversions WHERE folder = ? AND ssp = ? AND vars = ?",
+                               (writer.folder(self), ssp, ",".join(variables))).fetchone()
+        return None if row is None else {"inputs": json.loads(row[0]), "params": row[1], "end": row[2]}
+
+    def _record_conversion(self, writer, ssp, variables, inputs, params, end_date):
+        with _manifest_lock, self._manifest() as conn:
+            conn.execute("INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (writer.folder(self), ssp, ",".join(variables), writer.name, json.dumps(inputs), params,
+                          end_date.isoformat(), datetime.now().isoformat(timespec='seconds')))
+
+    def _tracks_outputs(self, writer):
+        # Writers without folder() and output_paths() cannot be checked against the manifest, so they always rewrite
+        return hasattr(writer, "folder") and hasattr(writer, "output_paths")
+
+    def _plan_unit(self, writer, ssp, variables, inputs, params):
+        # ("unchanged" | "append" | "write", first new day, inputs to decode) for one writer's outputs of a unit
+        output_paths = writer.output_paths(self, ssp, variables)
+        if not output_paths:
+            return "unchanged", None, None
+        record = self._conversion_record(writer, ssp, variables)
+        if record is None or record["params"] != params or not all(self._output().exists(path) for path in output_paths):
+            return "write", None, inputs
+        if record["inputs"] == inputs:
+            return "unchanged", None, None
+
+        # New years only extend the record when every earlier input is unchanged and all variables grew alike
+        old = record["inputs"]
+        new = {var: inputs[var][len(old.get(var, [])):] for var in variables}
+        end = pd.Timestamp(record["end"])
+        if (hasattr(writer, "append") and hasattr(writer, "last_date")
+                and all(var in old and inputs[var][:len(old[var])] == old[var] for var in variables)
+                and len({len(files) for files in new.values()}) == 1 and self._outputs_end(writer, output_paths, end)):
+            return "append", end + pd.Timedelta(days=1), new
+        return "write", None, inputs
+
+    def _outputs_end(self, writer, output_paths, end):
+        # Rows are appended block by block but recorded once the unit completes, so a run interrupted in between
+        # leaves some files already extended; appending is only safe when every output still ends on the record
+        for file_path in output_paths:
+            try:
+                if writer.last_date(self, file_path) != end.normalize():
+                    return False
+            except (OSError, ValueError):
+                return False
+        return True
+
+    def _read_unit_frames(self, ssp, variables, inputs, start=None, cells=None, scratch=None, report=True):
+        return [self._read_swat_series(ssp, var, [os.path.join(self._var_folder(part, var), filename)
+                                                  for part, filename, nbytes, mtime in inputs[var]],
+                                       start, cells, scratch, report)
+                for var in variables]
+
+    def _export_unit(self, ssp, variables, writers, parallel=False, incremental=True, chunk_cells=None,
+                     stage_cells=None):
+        # Decode and convert the unit once, then hand the same frames to every writer whose outputs are out of date;
+        # with chunk_cells the station writers get the unit one block of cells at a time. Out of core, stage_cells
+        # cells at a time are first transposed into memory-mapped scratch files and the blocks are emitted from there
+        inputs = self._unit_inputs(ssp, variables)
+        plans = []
+        for writer in writers:
+            params = self._unit_params(writer, variables)
+            action, start, files = (self._plan_unit(writer, ssp, variables, inputs, params)
+                                    if incremental and self._tracks_outputs(writer) else ("write", None, inputs))
+            plans.append((writer, params, action, start, files))
+        pending = [plan for plan in plans if plan[2] != "unchanged"]
+
+        ncells = len(self._unit_cells(variables)[0])
+        chunk_cells = min(chunk_cells or ncells, ncells)
+        stage_cells = min(max(stage_cells or ncells, chunk_cells), ncells) if self.out_of_core else chunk_cells
+        chunked = [plan for plan in pending if getattr(plan[0], "cell_chunks", False)]
+        whole = [plan for plan in pending if not getattr(plan[0], "cell_chunks", False)]
+        if stage_cells < ncells and whole:
+            print(f"  ... {', '.join(plan[0].name for plan in whole)} needs all {ncells} cells of {ssp}, "
+                  f"{', '.join(variables)} at once" + colored(" ... over memory budget", 'yellow'))
+            groups = [(chunked, self._cell_chunks(variables, stage_cells)), (whole, [None])]
+        else:
+            groups = [(pending, self._cell_chunks(variables, stage_cells))]
+
+        end_date = None
+        report = True  # missing days are reported once per unit
+        for group, stages in groups:
+            for cells in stages if group else []:
+                scratch = [] if self.out_of_core else None
+                try:
+                    # Only the new years are decoded when every writer of the group appends the same files
+                    if all(plan[2] == "append" and plan[3:] == group[0][3:] for plan in group):
+                        frames = self._read_unit_frames(ssp, variables, group[0][4], group[0][3], cells, scratch, report)
+                    else:
+                        frames = self._read_unit_frames(ssp, variables, inputs, cells=cells, scratch=scratch,
+                                                        report=report)
+                    report = False
+                    ncols = len(frames[0].columns)
+                    for writer, params, action, start, files in group:
+                        step = chunk_cells if getattr(writer, "cell_chunks", False) else ncols
+                        for first in range(0, ncols, step):
+                            blocks = frames if step >= ncols else [frame.iloc[:, first:first + step] for frame in frames]
+                            if action == "append":
+                                writer.append(self, ssp, variables, [block[block.index >= start] for block in blocks])
+                            else:
+                                writer.write(self, ssp, variables, blocks, parallel=parallel)
+                    end_date = frames[0].index.max()
+                    frames = blocks = None  # release the scratch maps before their files are removed
+                finally:
+                    for scratch_path in scratch or []:
+                        os.remove(scratch_path)
+        self._output().flush()  # conversions are only recorded once their files are complete
+        for writer, params, action, start, files in pending:
+            if self._tracks_outputs(writer):
+                self._record_conversion(writer, ssp, variables, inputs, params, end_date)
+
+        status = {"write": "written", "append": "appended", "unchanged": "unchanged"}
+        return ssp, variables, ", ".join(sorted({status[plan[2]] for plan in plans}))
+
+    def _convert_swat_unit(self, ssp, variables, parallel=False, incremental=True, chunk_cells=None, stage_cells=None):
+        return self._export_unit(ssp, variables, [SwatWriter()], parallel=parallel, incremental=incremental,
+                                 chunk_cells=chunk_cells, stage_cells=stage_cells)
+
+    def _daily_span(self, nc_files):
+        # Days from the first day of the first file to the last day of the last file, gaps included
+        span = []
+        for data_file_pth, position in [(nc_files[0], 0), (nc_files[-1], -1)]:
+            with nc.Dataset(data_file_pth, mode='r') as data_file:
+                time_var = data_file.variables['time']
+                calendar = _nc_calendar(time_var)
+                span.append(pd.Timestamp(str(nc.num2date(time_var[position], units=time_var.units, calendar=calendar))))
+        return (span[1] - span[0]).days + 1
+
+    def plan_conversion(self, units=None, max_memory=None, nworkers=None, min_chunk_cells=64, pool_workers=None,
+                        writer_processes=0):
+        # Size cell chunks and the number of workers from the NetCDF headers (grid, days, dtype), so that
+        # every worker's (days x chunk cells) float32 arrays plus formatting buffers fit the memory budget.
+        # pool_workers is the fixed size of a process pool shared with other jobs (EnsembleRunner), and
+        # writer_processes the station writers a single worker starts with write_swat_stations(parallel=True)
+        units = self._swat_units() if units is None else units
+        budget = int(max_memory or psutil.virtual_memory().available * self.memory_fraction)
+        overhead = 4 * 64 * 1024 ** 2  # station formatting blocks and decode buffers of one worker
+        unit_plans = []
+        for ssp, variables in units:
+            cell_bytes = 0
+            for var in variables:
+                nc_files = self._nc_files(self._var_folder("historical", var)) + self._nc_files(self._var_folder(ssp, var))
+                _, latitudes, longitudes = self._read_nc_headers(nc_files[:1], var)
+                # The continuous daily axis from the first to the last day, held as float32 whatever the stored dtype
+                days = self._daily_span(nc_files)
+                cell_bytes += days * np.dtype(np.float32).itemsize
+            unit_plans.append({"ssp": ssp, "vars": variables, "days": days,
+                               "cells": len(self.build_cell_index(latitudes, longitudes)),
+                               "cell_bytes": cell_bytes})
+        if not unit_plans:
+            return {"budget": budget, "workers": 1, "units": []}
+        # Leave a fifth of the free scratch disk untouched
+        scratch_bytes = shutil.disk_usage(self._scratch_dir()).free * 0.8 if self.out_of_core else 0
+
+        # Fewer workers rather than chunks too small to amortize reading every yearly file once per chunk;
+        # a shared pool keeps its size, so the budget is split across all of its processes
+        largest = max(unit_plans, key=lambda plan: plan["cell_bytes"] * plan["cells"])
+        workers = pool_workers or max(1, min(nworkers or self.nworkers, len(units)))
+        while not pool_workers and workers > 1 and ((budget // workers - overhead) // largest["cell_bytes"]
+                                                    < min(min_chunk_cells, largest["cells"])):
+            workers -= 1
+        # Parallel station writing ships every chunk to the writer processes: it is pickled and copied once more,
+        # and each writer holds its own formatting blocks
+        copies = 1
+        if writer_processes and workers == 1:
+            copies, overhead = 3, overhead * (1 + writer_processes)
+        worker_bytes = budget // workers - overhead
+        for plan in unit_plans:
+            plan["chunk_cells"] = int(max(1, min(plan["cells"], worker_bytes // (plan["cell_bytes"] * copies))))
+            plan["chunks"] = -(-plan["cells"] // plan["chunk_cells"])
+            # Out of core, each stage transposes as many cells as the scratch disk holds, the chunks are emitted
+            # from the memory-mapped stage
+            plan["stage_cells"] = (int(min(plan["cells"], max(plan["chunk_cells"], scratch_bytes // workers
+                                                              // plan["cell_bytes"])))
+                                   if self.out_of_core else plan["chunk_cells"])
+        if worker_bytes // (largest["cell_bytes"] * copies) < 1:
+            print(f"  ... a single cell of {largest['ssp']}, {', '.join(largest['vars'])} exceeds the memory budget"
+                  + colored(" ... over budget", 'yellow'))
+        print(f"  ... memory budget: {budget / 1024 ** 3:.2f} GB, workers: {workers}, largest unit: "
+              f"{largest['cells']} cells in {largest['chunks']} chunks of {largest['chunk_cells']}"
+              + (f", staged {largest['stage_cells']} cells at a time on disk" if self.out_of_core else "")
+              + colored(" ... planned", 'cyan'))
+        return {"budget": budget, "workers": workers, "units": unit_plans}
+
+    def convert_to_swat(self, parallel=False, incremental=True, max_memory=None):
         print(
             f"\n > Start converting netcdf to SWAT weather input formats"
             + colored(
                 " ... initiated", 'blue') + "\n")
 
-        data_dict_ssp, data_dict_hist, lat_lon_pairs = self.process_netcdf()
-        for ssp, dicts in data_dict_ssp.items():
-            save_folder = f'{self.working_dir}/{self.model_name}_SWAT_files'
-            os.makedirs(save_folder, exist_ok=True)
-
-            projected_dict = dicts
-            tasmax_df = pd.DataFrame()
-            tasmin_df = pd.DataFrame()
-            for var, hist_df in data_dict_hist.items():
-                names = hist_df.columns.tolist()
-
-                names_temp = ["temp_max_min" + "_" + item for item in names]
-                names = [var + "_" + item for item in names]
-                if var == "tasmin" or var == "tasmax":
-                    names = names_temp
-
-                ids = list(range(1, len(names) + 1))
-                elevation = [100] * len(names)
-                df_info = pd.DataFrame({
-                    'ID': ids,
-                    'NAME': names,
-                    'LAT': [lat for lat, lon in lat_lon_pairs],
-                    'LONG': [self._conv_360_180(lon) for lat, lon in lat_lon_pairs],
-                    'ELEVATION': elevation
-                })
-
-                if var == "tasmin" or var == "tasmax":
-                    save_path = os.path.join(save_folder, "temp_max_min" + ".txt")
-                else:
-                    save_path = os.path.join(save_folder, var + ".txt")
-                df_info.to_csv(save_path, index=False) # write 
-            
-                projected_df = projected_dict[var]
-                df_data = pd.concat([hist_df, projected_df])
-                df_data.index = pd.to_datetime(df_data.index.astype(str))
-                full_date_range = pd.date_range(start=df_data.index.min(), end=df_data.index.max(), freq='D')
-                missing_dates = full_date_range.difference(df_data.index)
-                for date in missing_dates:
-                    print(
-                        f" ... replaced missing value for {ssp}, {var}, {date.date()} with -99.0"
-                        + colored(" ... missing", 'yellow'))
-                df_data = df_data.reindex(full_date_range, fill_value=np.nan)
-                # print(type(df_data))
-                if var in ["tas", "tasmax", "tasmin"]:
-                    df_data = df_data - 273.15  # convert to degrees celsius
-                    
-                if var == "pr":
-                    df_data = df_data*86400  #1 kg/m2/s = 86400 mm/day
-                df_data = df_data.round(3)
-                data_save_pth = os.path.join(save_folder, ssp)
-                os.makedirs(data_save_pth, exist_ok=True)
-                date_string = df_data.index.min().strftime("%Y%m%d")
-
-                if var == "tasmax":
-                    tasmax_df = df_data
-                elif var == "tasmin":
-                    tasmin_df = df_data
-                else:
-                    if var in ["rlds", "rsds"]:
-                        df_data = df_data * 0.0036  # Convert to MJ/m^2
-                    for i, column in enumerate(df_data.columns):
-                        file_path = f'{data_save_pth}/{names[i]}.txt'
-                        with open(file_path, 'w') as f:
-                            f.write(date_string + '\n')  # Write the date as the first line
-                            df_data.fillna(-99.0, inplace=True)
-                            df_data[column].to_csv(f, index=False,
-                                                   header=False, lineterminator='\n')  # Write the DataFrame column to the file
-
-            for i, column in enumerate(tasmax_df.columns):
-                # Create a combined DataFrame for each corresponding pair of columns
-                combined_df = pd.DataFrame({
-                    'tmax': tasmax_df[column],
-                    'tmin': tasmin_df[column]
-                })
-
-                file_path = f'{data_save_pth}/{names[i]}.txt'
-                with open(file_path, 'w') as f:
-                    f.write(date_string + '\n')  # Write the date as the first line
-                    combined_df.fillna(-99.0, inplace=True)
-                    combined_df.to_csv(f, index=False, header=False, lineterminator='\n')  # Write the DataFrame column to the file
-
-    def convert_to_swatplus(self):
-        data_dict_ssp, data_dict_hist, lat_lon_pairs = self.process_netcdf()
-        for ssp, dicts in data_dict_ssp.items():
-            save_folder = f'{self.working_dir}/{self.model_name}_SWATplus_files'
-            os.makedirs(save_folder, exist_ok=True)
-
-            projected_dict = dicts
-            tasmax_df = pd.DataFrame()
-            tasmin_df = pd.DataFrame()
-            for var, hist_df in data_dict_hist.items():
-                names = hist_df.columns.tolist()
-
-                names_temp = ["temp_max_min" + "_" + item for item in names]
-                names = [var + "_" + item for item in names]
-                if var == "tasmin" or var == "tasmax": 
-                    names = names_temp
-
-                ids = list(range(1, len(names) + 1))
-                elevation = [100] * len(names)
-                df_info = pd.DataFrame({
-                    'ID': ids,
-                    'NAME': names,
-                    'LAT': [lat for lat, lon in lat_lon_pairs],
-                    'LONG': [self._conv_360_180(lon) for lat, lon in lat_lon_pairs],
-                    'ELEVATION': elevation
-                })
-                if var == "tasmin" or var == "tasmax":
-                    filenam = "tmp.cli"
-                    des = "temperature file names"
-                    save_path = os.path.join(save_folder, filenam)
-                elif var == "pr":
-                    filenam = "pcp.cli"
-                    des = "precipitation file names"
-                    save_path = os.path.join(save_folder, filenam)
-                elif var == "hurs":
-                    filenam = "hmd.cli"
-                    des = "humidity file names"
-                    save_path = os.path.join(save_folder, filenam)
-                elif var == "sfcWind":
-                    filenam = "wnd.cli"
-                    des = "wind speed file names"                    
-                    save_path = os.path.join(save_folder, filenam)
-                elif var == "rlds": #NOTE: check whether long or short
-                    filenam = "slr.cli"
-                    des = "solar radiation file names"        
-                    save_path = os.path.join(save_folder, filenam)
-                else:
-                    save_path = os.path.join(save_folder, var + ".txt")
-
-                firstline, secondline = self._header(filenam, des)
-                with open(save_path, 'w') as f:
-                    f.write(firstline + '\n')  # Write the date as the first line
-                    f.write(secondline + '\n')  # Write the date as the first line
-                    df_info['NAME'].to_csv(f, index=False,
-                                            header=False, lineterminator='\n')  # Write the DataFrame column to the file
-    '''
-                # df_info.to_csv(save_path, index=False) # write climate info
-
-                projected_df = projected_dict[var]
-                df_data = pd.concat([hist_df, projected_df])
-
-                df_data.index = pd.to_datetime(df_data.index.astype(str))
-                full_date_range = pd.date_range(start=df_data.index.min(), end=df_data.index.max(), freq='D')
-                missing_dates = full_date_range.difference(df_data.index)
-                # for date in missing_dates:
-                #     print(f"Missing dates for ssp: {ssp}, variable: {var}: {date.date()}")
-
-                df_data = df_data.reindex(full_date_range, fill_value=-99.0)
-                if var in ["tas", "tasmax", "tasmin"]:
-                    df_data = df_data - 273.15  # convert to degrees celsius
-
-                df_data = df_data.round(3)
-                data_save_pth = os.path.join(save_folder, ssp)
-                os.makedirs(data_save_pth, exist_ok=True)
-                date_string = df_data.index.min().strftime("%Y%m%d")
-
-                if var == "tasmax":
-                    tasmax_df = df_data
-                elif var == "tasmin":
-                    tasmin_df = df_data
-                else:
-                    if var in ["rlds", "rsds"]:
-                        df_data = df_data * 0.0036  # Convert to MJ/m^2
-
-
-                    for i, column in enumerate(df_data.columns):
-                        file_path = f'{data_save_pth}/{names[i]}.txt'
-                        with open(file_path, 'w') as f:
-                            f.write(date_string + '\n')  # Write the date as the first line
-                            df_data[column].to_csv(f, index=False,
-                                                   header=False, lineterminator='\n')  # Write the DataFrame column to the file
-
-            for i, column in enumerate(tasmax_df.columns):
-                # Create a combined DataFrame for each corresponding pair of columns
-                combined_df = pd.DataFrame({
-                    'tmax': tasmax_df[column],
-                    'tmin': tasmin_df[column]
-                })
-
-                file_path = f'{data_save_pth}/{names[i]}.txt'
-                with open(file_path, 'w') as f:
-                    f.write(date_string + '\n')  # Write the date as the first line
-                    combined_df.to_csv(f, index=False, header=False)  # Write the DataFrame column to the file
-    '''
+        save_folder = self._swat_folder()
+        units = self._swat_units()
+        plan = self.plan_conversion(units, max_memory, nworkers=1, writer_processes=self.nworkers if parallel else 0)
+        with self.metrics.stage("convert_to_swat", model=self.model_name, units=len(units)):
+            self._output().begin(self, [SwatWriter.name])
+            self._write_swat_indexes(save_folder, units)
+
+            for unit in plan["units"]:
+                ssp, variables = unit["ssp"], unit["vars"]
+                with self.metrics.stage("convert_swat_unit", model=self.model_name, ssp=ssp, vars=list(variables),
+                                        chunks=unit["chunks"]):
+                    self._convert_swat_unit(ssp, variables, parallel=parallel, incremental=incremental,
+                                            chunk_cells=unit["chunk_cells"], stage_cells=unit["stage_cells"])
+            self._output().close()
+
+    def convert_to_swat_parallel(self, nworkers=None, max_memory=None, incremental=True):
+        if not self._output().concurrent:
+            print(f"  ... {self._output().name} output is written by a single process" + colored(" ... sequential", 'yellow'))
+            return self.convert_to_swat(incremental=incremental, max_memory=max_memory)
+        save_folder = self._swat_folder()
+        units = self._swat_units()
+        if not units:
+            return
+        self._output().begin(self, [SwatWriter.name])
+        self._write_swat_indexes(save_folder, units)
+
+        plan = self.plan_conversion(units, max_memory, nworkers)
+        nworkers = plan["workers"]
+        print(
+            f"\n > Start converting netcdf to SWAT weather input formats"
+            + colored(f" with {nworkers} workers", 'magenta')
+            + colored(
+                " ... initiated", 'blue') + "\n")
+
+        # Each worker reads its own NetCDF slice; the larger tasmax/tasmin units are scheduled first
+        units = sorted(plan["units"], key=lambda unit: len(unit["vars"]), reverse=True)
+        with self.metrics.stage("convert_to_swat_parallel", model=self.model_name, units=len(units), workers=nworkers), \
+                ProcessPoolExecutor(max_workers=nworkers) as executor:
+            tasks = [executor.submit(self._convert_swat_unit, unit["ssp"], unit["vars"], incremental=incremental,
+                                     chunk_cells=unit["chunk_cells"], stage_cells=unit["stage_cells"])
+                     for unit in units]
+            for future in as_completed(tasks):
+                ssp, variables, status = future.result()
+                print(f"  ... ssp: {ssp}, Var: {', '.join(variables)}" + colored(f" ... {status}", 'green'))
+        self._output().close()
+
+    def export(self, targets=("swat", "swatplus"), nworkers=1, max_memory=None, parallel=False, incremental=True):
+        # Single pass over the NetCDF archive: each (ssp, variables) unit is decoded once and fed to every target;
+        # with incremental=True only outputs whose input files or conversion parameters changed are regenerated
+        writers = [EXPORT_WRITERS[target]() if isinstance(target, str) else target for target in targets]
+        units = self._swat_units()
+        if not units:
+            return
+        output = self._output()
+        if not output.concurrent and (nworkers or self.nworkers) > 1:
+            print(f"  ... {output.name} output is written by a single process" + colored(" ... sequential", 'yellow'))
+            nworkers = 1
+        plan = self.plan_conversion(units, max_memory, nworkers, writer_processes=self.nworkers if parallel else 0)
+        nworkers = plan["workers"]
+        print(
+            f"\n > Start exporting netcdf to {', '.join(writer.name for writer in writers)}"
+            + (colored(f" with {nworkers} workers", 'magenta') if nworkers > 1 else "")
+            + colored(
+                " ... initiated", 'blue') + "\n")
+
+        with self.metrics.stage("export", model=self.model_name, units=len(units), workers=nworkers,
+                                targets=[writer.name for writer in writers]):
+            output.begin(self, [writer.name for writer in writers])
+            for writer in writers:
+                writer.begin(self, units)
+
+            if nworkers == 1:
+                for unit in plan["units"]:
+                    with self.metrics.stage("export_unit", model=self.model_name, ssp=unit["ssp"],
+                                            vars=list(unit["vars"]), chunks=unit["chunks"]):
+                        ssp, variables, status = self._export_unit(unit["ssp"], unit["vars"], writers, parallel=parallel,
+                                                                   incremental=incremental,
+                                                                   chunk_cells=unit["chunk_cells"],
+                                                                   stage_cells=unit["stage_cells"])
+                    print(f"  ... ssp: {ssp}, Var: {', '.join(variables)}" + colored(f" ... {status}", 'green'))
+                output.close()
+                return
+
+            units = sorted(plan["units"], key=lambda unit: len(unit["vars"]), reverse=True)
+            with ProcessPoolExecutor(max_workers=nworkers) as executor:
+                tasks = [executor.submit(self._export_unit, unit["ssp"], unit["vars"], writers, incremental=incremental,
+                                         chunk_cells=unit["chunk_cells"], stage_cells=unit["stage_cells"])
+                         for unit in units]
+                for future in as_completed(tasks):
+                    ssp, variables, status = future.result()
+                    print(f"  ... ssp: {ssp}, Var: {', '.join(variables)}" + colored(f" ... {status}", 'green'))
+            output.close()
+
+    def convert_to_swatplus(self, incremental=True):
+        # SWAT+ station files and .cli lists; use export(["swat", "swatplus"]) to write both formats from one read
+        self.export(["swatplus"], incremental=incremental)
 
     def _header(self, filenam, des):
         time = datetime.now().strftime('- %m/%d/%y %H:%M:%S -')
@@ -414,14 +2112,156 @@ class ClimateDataDownloader:
     
 
     def write_ok_log_file(self, ssp, var, date):
-        with open(os.path.join(self.working_dir, "downloadednc.log"), "a") as f:
-            # f.write("# log files created by swatp_pst\n")
-            f.write(f"{ssp},{var},{date},ok\n")
+        # Appended by the single metrics writer thread, so concurrent workers never interleave lines
+        self.metrics.log(f"{ssp},{var},{date},ok")
 
     def write_failed_log_file(self, ssp, var, date):
-        with open(os.path.join(self.working_dir, "downloadednc.log"), "a") as f:
-            # f.write("# log files created by swatp_pst\n")
-            f.write(f"{ssp},{var},{date},failed\n")
+        self.metrics.log(f"{ssp},{var},{date},failed")
+
+
+class EnsembleRunner:
+    # Runs many (model, member, ssps, vars) jobs with one shared download thread pool and one shared
+    # conversion process pool; a model's conversion starts as soon as all of its files are downloaded
+    # and validated, while other models are still downloading
+    def __init__(self, working_dir, dataset_name, jobs, versions_avail, download_workers=None, convert_workers=None,
+                 max_memory=None, output_backend="directory"):
+        backend = OUTPUT_BACKENDS[output_backend] if isinstance(output_backend, str) else output_backend
+        if not backend.concurrent:
+            # Units of every model run in the shared process pool, which a single archive stream cannot follow
+            raise ValueError(f"{backend.name} output is written by a single process and cannot be used by "
+                             f"EnsembleRunner; use one of the directory backends or export() per model")
+        self.working_dir = working_dir
+        self.dataset_name = dataset_name
+        self.versions_avail = versions_avail
+        # Higher priority jobs are queued first in both pools
+        self.jobs = sorted(jobs, key=lambda job: job.get("priority", 0), reverse=True)
+        self.download_workers = download_workers or psutil.cpu_count(logical=False)
+        self.convert_workers = convert_workers or psutil.cpu_count(logical=False)
+        self.max_memory = max_memory # conversion budget shared by the whole pool, defaults to memory_fraction of the RAM
+        self.output_backend = output_backend # "directory", "combined" or "sharded" (or an instance), per downloader
+        self.progress = {}
+
+    def _state_path(self):
+        return os.path.join(self.working_dir, "ensemble_state.json")
+
+    def _load_state(self):
+        if not os.path.exists(self._state_path()):
+            return {}
+        with open(self._state_path()) as f:
+            return json.load(f)
+
+    def _save_state(self, state):
+        with open(self._state_path() + ".tmp", "w") as f:
+            json.dump(state, f, indent=1)
+        os.replace(self._state_path() + ".tmp", self._state_path())
+
+    def _downloaders(self):
+        members = {}
+        for job in self.jobs:
+            members.setdefault(job["model"], set()).add(job["member"])
+        downloaders = []
+        for job in self.jobs:
+            downloader = ClimateDataDownloader(self.working_dir, self.dataset_name, job["model"], job["ssps"],
+                                               job["member"], job["vars"], self.versions_avail)
+            if len(members[job["model"]]) > 1:
+                downloader.output_suffix = f"_{job['member']}"
+            downloader.output_backend = (self.output_backend if isinstance(self.output_backend, str)
+                                         else copy.deepcopy(self.output_backend))
+            if downloaders:
+                downloader._metrics = downloaders[0][1].metrics  # one writer thread for the whole ensemble
+            downloaders.append((f"{job['model']}_{job['member']}", downloader))
+        return downloaders
+
+    def _print_progress(self, key, metrics):
+        progress = self.progress[key]
+        metrics.message(f"  ... M: {key}, downloads: {progress['downloaded']}/{progress['files']}"
+              f" (failed: {progress['failed']}), conversions: {progress['converted']}/{progress['units']}"
+              + colored(f" ... {progress['status']}", 'magenta'))
+
+    def run(self, resume=True):
+        state = self._load_state() if resume else {}
+        downloaders = self._downloaders()
+        downloaders[0][1]._start_download_log(resume)
+        metrics = downloaders[0][1].metrics
+        budget = int(self.max_memory or psutil.virtual_memory().available * downloaders[0][1].memory_fraction)
+        print(
+            f"\n > Start ensemble run of {len(downloaders)} jobs"
+            + colored(f" with {self.download_workers} download and {self.convert_workers} conversion workers", 'magenta')
+            + colored(
+                " ... initiated", 'blue') + "\n")
+
+        with ThreadPoolExecutor(max_workers=self.download_workers) as download_pool, \
+                ProcessPoolExecutor(max_workers=self.convert_workers) as convert_pool:
+            # Start the conversion processes before any download thread runs: a process forked later copies
+            # netcdf_lock (and HDF5's own locks) as held by a download thread and hangs on its first NetCDF read
+            convert_pool.submit(os.getpid).result()
+            download_tasks = {}
+            for key, downloader in downloaders:
+                file_jobs = [] if state.get(key) == "converted" else downloader._download_jobs(resume)
+                metrics.start(len(file_jobs))
+                self.progress[key] = {"files": len(file_jobs), "downloaded": 0, "failed": 0,
+                                      "units": 0, "converted": 0,
+                                      "status": "done" if state.get(key) == "converted" else "downloading"}
+                for var, ssp, date, save_folder in file_jobs:
+                    future = download_pool.submit(downloader.download_with_retries, downloader.versions_avail[-1],
+                                                  var, ssp, date, save_folder)
+                    download_tasks[future] = key
+
+            convert_tasks = {}
+
+            def start_conversion(key, downloader):
+                # Index files are written here once; every (ssp, variables) unit then runs in the process pool.
+                # The headers are read under netcdf_lock, as download threads of other models are still validating
+                with netcdf_lock:
+                    units = downloader._swat_units()
+                    self.progress[key]["missing"] = len(downloader._download_jobs(resume=True))
+                    save_folder = downloader._swat_folder()
+                    downloader._output().begin(downloader, [SwatWriter.name])
+                    downloader._write_swat_indexes(save_folder, units)
+                    downloader._output().flush()  # the index files are complete before any unit starts
+                    # Every process of the shared pool gets its share of the budget, whichever model it converts
+                    plan = downloader.plan_conversion(units, budget, pool_workers=self.convert_workers)
+                self.progress[key].update(units=len(units), status="converting" if units else "done")
+                for unit in plan["units"]:
+                    task = convert_pool.submit(downloader._convert_swat_unit, unit["ssp"], unit["vars"],
+                                               chunk_cells=unit["chunk_cells"], stage_cells=unit["stage_cells"])
+                    convert_tasks[task] = key
+                self._print_progress(key, metrics)
+
+            for key, downloader in downloaders:
+                if self.progress[key]["status"] == "downloading" and self.progress[key]["files"] == 0:
+                    start_conversion(key, downloader)
+
+            # Pipeline: each model is handed to the conversion pool as soon as its last download completes
+            for future in as_completed(download_tasks):
+                key = download_tasks[future]
+                try:
+                    self.progress[key]["downloaded" if future.result() else "failed"] += 1
+                except Exception as e: # Raise any exceptions that occurred during download
+                    metrics.message(f"Download failed with exception: {e}")
+                    self.progress[key]["failed"] += 1
+                progress = self.progress[key]
+                if progress["downloaded"] + progress["failed"] == progress["files"]:
+                    start_conversion(key, dict(downloaders)[key])
+
+            for future in as_completed(convert_tasks):
+                key = convert_tasks[future]
+                try:
+                    future.result()
+                    self.progress[key]["converted"] += 1
+                except Exception as e:
+                    print(f"Conversion failed for {key} with exception: {e}")
+                progress = self.progress[key]
+                if progress["converted"] == progress["units"]:
+                    progress["status"] = "done"
+                    # Jobs with files still missing from the manifest are picked up again on resume
+                    state[key] = "converted" if progress.get("missing", 0) == 0 else "partial"
+                    self._save_state(state)
+                    self._print_progress(key, metrics)
+        for key, downloader in downloaders:
+            downloader._output().close()
+        metrics.flush()
+        return self.progress
 
 
 # Example usage
@@ -0,0 +1,225 @@
+from contextlib import redirect_stdout
+from datetime import datetime
+import argparse
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import geopandas as gpd
+import numpy as np
+import psutil
+import shapely
+from termcolor import colored
+
+from NASA_earth_exchange import ClimateDataDownloader, aiohttp, OUTPUT_BACKENDS
+from fake_thredds import start_server, write_synthetic_nc, GRID_RES
+
+
+# Benchmarks the download, ingest and conversion stages on synthetic NEX-GDDP-CMIP6 data,
+# using fake_thredds.py as a local stand-in for the NCSS endpoint.
+
+DATASET = "GDDP-CMIP6"
+VERSIONS = ["", "_v1.1", "_v1.2"]
+
+
+def write_synthetic_shapefile(working_dir, nlat, nlon, south=30.0, west=-97.0):
+    # One rectangular subbasin per grid cell, so the shapefile bounds cover exactly nlat x nlon cells
+    geometries = [shapely.box(west + j * GRID_RES + 0.01, south + i * GRID_RES + 0.01,
+                              west + (j + 1) * GRID_RES - 0.01, south + (i + 1) * GRID_RES - 0.01)
+                  for i in range(nlat) for j in range(nlon)]
+    gdf = gpd.GeoDataFrame({"Subbasin": np.arange(1, len(geometries) + 1)}, geometry=geometries, crs="EPSG:4326")
+    gdf.to_file(os.path.join(working_dir, "subs1.shp"))
+
+
+def make_synthetic_archive(working_dir, model, member, ssps, variables, hist_years, proj_years, nlat, nlon,
+                           south=30.0, west=-97.0):
+    # Yearly files laid out as {working_dir}/{dataset}/{model}/{ssp}/{member}/{var}/
+    # {var}_day_{model}_{ssp}_{member}_gn_{year}{vers}.nc, as written by ClimateDataDownloader
+    lats = south + GRID_RES / 2 + GRID_RES * np.arange(nlat)
+    lons = (west + GRID_RES / 2 + GRID_RES * np.arange(nlon)) % 360
+    nbytes = 0
+    for ssp in ssps:
+        years = hist_years if ssp == "historical" else proj_years
+        for var in variables:
+            save_folder = f"{working_dir}/{DATASET}/{model}/{ssp}/{member}/{var}"
+            os.makedirs(save_folder, exist_ok=True)
+            for year in years:
+                file_path = os.path.join(save_folder, f"{var}_day_{model}_{ssp}_{member}_gn_{year}{VERSIONS[-1]}.nc")
+                write_synthetic_nc(file_path, var, [year], lats, lons)
+                nbytes += os.path.getsize(file_path)
+    return nbytes
+
+
+class PeakRSS:
+    # Samples the resident set size of this process and its children (process pools) in the background
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _rss(self):
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self._rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def _archive_size(working_dir, model):
+    files = nbytes = 0
+    for root, _, filenames in os.walk(os.path.join(working_dir, DATASET, model)):
+        for filename in filenames:
+            if filename.endswith(".nc"):
+                files += 1
+                nbytes += os.path.getsize(os.path.join(root, filename))
+    return files, nbytes
+
+
+def run_stage(name, grid, func, working_dir, model, cells, verbose=False):
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        if verbose:
+            func()
+        else:
+            with redirect_stdout(io.StringIO()):
+                func()
+        seconds = time.perf_counter() - start
+    files, nbytes = _archive_size(working_dir, model)
+    return {
+        "stage": name,
+        "grid": grid,
+        "seconds": round(seconds, 3),
+        "files_per_s": round(files / seconds, 1),
+        "mb_per_s": round(nbytes / 1024 ** 2 / seconds, 2),
+        "cells_per_s": round(cells / seconds, 1),
+        "peak_rss_mb": round(rss.peak / 1024 ** 2, 1),
+    }
+
+
+def benchmark_grid(root, nlat, nlon, args):
+    grid = f"{nlat}x{nlon}"
+    working_dir = os.path.join(root, grid)
+    os.makedirs(working_dir, exist_ok=True)
+    write_synthetic_shapefile(working_dir, nlat, nlon)
+    hist_years = list(range(args.hist_years[0], args.hist_years[1] + 1))
+    proj_years = list(range(args.proj_years[0], args.proj_years[1] + 1))
+    ssps = ["historical"] + args.ssps
+
+    def downloader():
+        instance = ClimateDataDownloader(working_dir, DATASET, args.model, ssps, args.member, args.variables, VERSIONS)
+        instance.dates_historical = np.array(hist_years)
+        instance.dates_projected = np.array(proj_years)
+        instance.ncss_url = server.ncss_url
+        instance.timeout = 0.1
+        instance.output_backend = args.output_backend
+        return instance
+
+    def fresh_download():
+        shutil.rmtree(os.path.join(working_dir, DATASET), ignore_errors=True)
+        for filename in ["download_manifest.sqlite", "downloadednc.log"]:
+            if os.path.exists(os.path.join(working_dir, filename)):
+                os.remove(os.path.join(working_dir, filename))
+
+    # Every series holds all grid cells of one (ssp, var); conversion units join historical + projected
+    ncells = nlat * nlon
+    series_cells = ncells * len(ssps) * len(args.variables)
+    unit_cells = ncells * len(args.ssps) * len(args.variables)
+    results = []
+    server = start_server(latency=args.latency, error_rate=args.error_rate)
+    try:
+        if "download" in args.stages:
+            fresh_download()
+            results.append(run_stage("download_all", grid, downloader().download_all,
+                                     working_dir, args.model, series_cells, args.verbose))
+        if "download_async" in args.stages and aiohttp is not None:
+            fresh_download()
+            results.append(run_stage("download_all_async", grid, downloader().download_all_async,
+                                     working_dir, args.model, series_cells, args.verbose))
+    finally:
+        server.shutdown()
+    if not any(stage.startswith("download") for stage in args.stages):
+        fresh_download()
+        make_synthetic_archive(working_dir, args.model, args.member, ssps, args.variables,
+                               hist_years, proj_years, nlat, nlon)
+
+    def process():
+        for _ in downloader().iter_netcdf():
+            pass
+
+    stages = [
+        ("process", "iter_netcdf", process, series_cells),
+        # Full rewrites, so repeated stages and grids are not skipped as unchanged by the incremental conversion
+        ("convert", "convert_to_swat", lambda: downloader().convert_to_swat(incremental=False), unit_cells),
+        ("convert_parallel", "convert_to_swat_parallel",
+         lambda: downloader().convert_to_swat_parallel(incremental=False), unit_cells),
+        ("consolidate", "consolidate", lambda: downloader().consolidate(), series_cells),
+    ]
+    for stage, name, func, cells in stages:
+        if stage in args.stages:
+            results.append(run_stage(name, grid, func, working_dir, args.model, cells, args.verbose))
+    return results
+
+
+def print_results(results):
+    columns = ["grid", "stage", "seconds", "files_per_s", "mb_per_s", "cells_per_s", "peak_rss_mb"]
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark nc2swat stages on synthetic data and a fake NCSS server")
+    parser.add_argument("--grids", nargs="*", default=["4x4", "16x16", "32x32"], help="grid sizes as NLATxNLON")
+    parser.add_argument("--hist-years", nargs=2, type=int, default=[1950, 1954], metavar=("FIRST", "LAST"))
+    parser.add_argument("--proj-years", nargs=2, type=int, default=[2015, 2019], metavar=("FIRST", "LAST"))
+    parser.add_argument("--ssps", nargs="*", default=["ssp245"])
+    parser.add_argument("--variables", nargs="*", default=["pr", "tasmax", "tasmin"])
+    parser.add_argument("--model", default="SYNTH-ESM")
+    parser.add_argument("--member", default="r1i1p1f1")
+    parser.add_argument("--stages", nargs="*",
+                        default=["download", "download_async", "process", "convert", "convert_parallel", "consolidate"])
+    parser.add_argument("--output-backend", default="directory", choices=sorted(OUTPUT_BACKENDS),
+                        help="where the convert stages write station files")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean fake server latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 504")
+    parser.add_argument("--workdir", default=None, help="keep the synthetic data here instead of a temp directory")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the benchmarked stages")
+    args = parser.parse_args()
+
+    print(f"\n > Start benchmark ... {datetime.now():%m/%d/%y %H:%M:%S}" + colored(" ... initiated", 'blue') + "\n")
+    root = args.workdir or tempfile.mkdtemp(prefix="nc2swat_bench_")
+    results = []
+    try:
+        for grid in args.grids:
+            nlat, nlon = (int(size) for size in grid.lower().split("x"))
+            results.extend(benchmark_grid(root, nlat, nlon, args))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(root, ignore_errors=True)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,162 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from datetime import date, datetime
+import argparse
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import numpy as np
+import netCDF4 as nc
+
+from NASA_earth_exchange import netcdf_lock
+
+
+# Local stand-in for the NCCS THREDDS NetCDF Subset Service (NCSS) used by ClimateDataDownloader.
+# It answers the same subset URLs with synthetic NEX-GDDP-CMIP6 style files on a 0.25 degree grid,
+# and can inject latency, 504 gateway timeouts and missing version suffixes.
+
+GRID_RES = 0.25
+VAR_RANGES = {
+    # var: (mean, seasonal amplitude, spatial gradient) in the native units of the dataset
+    "pr": (3.0e-5, 2.0e-5, 1.0e-6),
+    "tas": (288.0, 10.0, 0.5),
+    "tasmax": (294.0, 10.0, 0.5),
+    "tasmin": (282.0, 10.0, 0.5),
+    "hurs": (70.0, 15.0, 1.0),
+    "huss": (0.01, 0.004, 0.0002),
+    "rlds": (350.0, 40.0, 2.0),
+    "rsds": (200.0, 80.0, 2.0),
+    "sfcWind": (3.5, 1.5, 0.1),
+}
+
+
+def grid_axes(north, west, east, south):
+    # Cell centres (k * 0.25 + 0.125) inside the bounding box; longitudes on the 0..360 axis of the dataset
+    lats = np.arange(np.floor(south / GRID_RES), np.ceil(north / GRID_RES)) * GRID_RES + GRID_RES / 2
+    lats = lats[(lats >= south) & (lats <= north)]
+    lons = np.arange(np.floor(west / GRID_RES), np.ceil(east / GRID_RES)) * GRID_RES + GRID_RES / 2
+    lons = lons[(lons >= west) & (lons <= east)]
+    if len(lats) == 0:
+        lats = np.array([np.floor((south + north) / 2 / GRID_RES) * GRID_RES + GRID_RES / 2])
+    if len(lons) == 0:
+        lons = np.array([np.floor((west + east) / 2 / GRID_RES) * GRID_RES + GRID_RES / 2])
+    return lats, lons % 360
+
+
+def write_synthetic_nc(file_path, var, years, lats, lons, calendar="standard"):
+    # Values are a deterministic function of (day, lat, lon), so overlapping subsets always agree
+    days = [(date(year, 1, 1) - date(1950, 1, 1)).days + np.arange((date(year + 1, 1, 1) - date(year, 1, 1)).days)
+            for year in years]
+    days = np.concatenate(days)
+    mean, amplitude, gradient = VAR_RANGES.get(var, (1.0, 0.5, 0.01))
+    season = np.sin(2 * np.pi * days / 365.25)[:, None, None]
+    lat_grid, lon_grid = np.meshgrid(lats, (lons + 180) % 360 - 180, indexing="ij")
+    noise = np.sin(days[:, None, None] * 12.9898 + lat_grid * 78.233 + lon_grid * 37.719)
+    values = mean + amplitude * (season + 0.3 * noise) + gradient * (lat_grid - lon_grid)
+    values = np.maximum(values, 0) if var == "pr" else values
+
+    with netcdf_lock, nc.Dataset(file_path, "w", format="NETCDF3_64BIT_OFFSET") as data_file:
+        data_file.createDimension("time", None)
+        data_file.createDimension("lat", len(lats))
+        data_file.createDimension("lon", len(lons))
+        time_var = data_file.createVariable("time", "f8", ("time",))
+        time_var.units = "days since 1950-01-01 00:00:00"
+        time_var.calendar = calendar
+        time_var[:] = days + 0.5
+        data_file.createVariable("lat", "f8", ("lat",))[:] = lats
+        data_file.createVariable("lon", "f8", ("lon",))[:] = lons
+        var_data = data_file.createVariable(var, "f4", ("time", "lat", "lon"), fill_value=np.float32(1.0e20))
+        var_data[:] = values.astype(np.float32)
+
+
+class FakeNCSSHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so pooled clients can reuse connections
+    path_pattern = re.compile(r".*/ncss/grid/AMES/NEX/([^/]+)/([^/]+)/([^/]+)/([^/]+)/([^/]+)/"
+                              r"[^/]+_gn_(\d{4})(?:-\d{4})?(.*)\.nc$")
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.stats["requests"] += 1
+        if server.latency:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+
+        url = urlparse(self.path)
+        match = self.path_pattern.match(url.path)
+        if match is None:
+            return self._reply(404)
+        vers = match.group(7)
+        if vers not in server.versions:
+            return self._reply(404)
+        if random.random() < server.error_rate:
+            return self._reply(504)
+
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        var = query["var"]
+        north, south = float(query["north"]), float(query["south"])
+        west, east = float(query["west"]) % 360, float(query["east"]) % 360
+        if east < west:  # box crosses the prime meridian
+            east += 360
+        lats, lons = grid_axes(north, west, east, south)
+        years = range(int(query["time_start"][:4]), int(query["time_end"][:4]) + 1)
+        if len(lats) * len(lons) * len(years) * 366 * 4 > server.max_response_bytes:
+            return self._reply(504)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "subset.nc")
+            write_synthetic_nc(file_path, var, years, lats, lons)
+            with open(file_path, "rb") as f:
+                body = f.read()
+        with server.lock:
+            server.stats["bytes"] += len(body)
+        self._reply(200, body)
+
+    def _reply(self, status, body=b""):
+        if status != 200:
+            with self.server.lock:
+                self.server.stats[str(status)] = self.server.stats.get(str(status), 0) + 1
+        self.send_response(status)
+        self.send_header("Content-Type", "application/x-netcdf" if status == 200 else "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, versions=("", "_v1.1", "_v1.2"),
+                 max_response_bytes=2 * 1024 ** 3):
+    # Serve on a background thread; point ClimateDataDownloader.ncss_url at server.ncss_url
+    server = ThreadingHTTPServer((host, port), FakeNCSSHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.versions = set(versions)
+    server.max_response_bytes = max_response_bytes
+    server.lock = threading.Lock()
+    server.stats = {"requests": 0, "bytes": 0}
+    server.ncss_url = f"http://{host}:{server.server_address[1]}/thredds/ncss/grid/AMES/NEX"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the NCCS THREDDS NCSS endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean per-request latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 504")
+    parser.add_argument("--versions", nargs="*", default=["", "_v1.1", "_v1.2"], help="version suffixes to serve")
+    args = parser.parse_args()
+
+    server = start_server(args.host, args.port, args.latency, args.error_rate, args.versions)
+    print(f" > Fake NCSS server listening on {server.ncss_url} ... {datetime.now():%m/%d/%y %H:%M:%S}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
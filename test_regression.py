@@ -0,0 +1,152 @@
+import glob
+import os
+
+import geopandas as gpd
+import netCDF4 as nc
+import numpy as np
+import pytest
+import shapely
+
+from NASA_earth_exchange import ClimateDataDownloader, SwatPlusWriter, SwatWriter, aiohttp
+from benchmark import DATASET, VERSIONS, make_synthetic_archive, write_synthetic_shapefile
+from fake_thredds import start_server
+
+
+# Regression checks on the synthetic archive of benchmark.py: every memory-saving or incremental path must
+# write the same files as the plain full conversion. Run with python -m pytest test_regression.py
+
+MODEL, MEMBER = "M", "r1i1p1f1"
+SSPS = ["historical", "ssp245"]
+VARIABLES = ["pr", "tasmax", "tasmin"]
+NLAT, NLON = 12, 12  # 144 cells, more than the 64-cell minimum chunk, so tight budgets split every unit
+
+
+def synthetic_archive(working_dir, proj_years=(2015,)):
+    write_synthetic_shapefile(working_dir, NLAT, NLON)
+    make_synthetic_archive(working_dir, MODEL, MEMBER, SSPS, VARIABLES, [1950, 1951], list(proj_years), NLAT, NLON)
+
+
+def downloader(working_dir, output_suffix=""):
+    instance = ClimateDataDownloader(str(working_dir), DATASET, MODEL, SSPS, MEMBER, VARIABLES, VERSIONS)
+    instance.output_suffix = output_suffix
+    return instance
+
+
+def read_outputs(folder):
+    # {path relative to folder: bytes} of every file written below folder
+    outputs = {}
+    for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+            with open(os.path.join(root, filename), 'rb') as f:
+                outputs[os.path.relpath(os.path.join(root, filename), folder)] = f.read()
+    return outputs
+
+
+def test_chunked_conversion_matches_full(tmp_path):
+    synthetic_archive(tmp_path)
+    chunked = downloader(tmp_path, "_chunked")
+    assert min(unit["chunks"] for unit in chunked.plan_conversion(max_memory=1, nworkers=1)["units"]) > 1
+
+    downloader(tmp_path, "_full").convert_to_swat(incremental=False)
+    chunked.convert_to_swat(incremental=False, max_memory=1)
+    full = read_outputs(tmp_path / f"{MODEL}_full_SWAT_files")
+    assert len(full) > NLAT * NLON
+    assert read_outputs(tmp_path / f"{MODEL}_chunked_SWAT_files") == full
+
+
+def test_out_of_core_conversion_matches_in_memory(tmp_path):
+    synthetic_archive(tmp_path)
+    downloader(tmp_path, "_memory").convert_to_swat(incremental=False)
+    memory = read_outputs(tmp_path / f"{MODEL}_memory_SWAT_files")
+
+    # Chunks emitted from one staged transposition, as planned for a tight budget
+    out_of_core = downloader(tmp_path, "_ooc")
+    out_of_core.out_of_core = True
+    out_of_core.convert_to_swat(incremental=False, max_memory=1)
+    assert read_outputs(tmp_path / f"{MODEL}_ooc_SWAT_files") == memory
+
+    # Several stages of 100 cells through the scratch files, each emitted in blocks of up to 64 cells
+    staged = downloader(tmp_path, "_staged")
+    staged.out_of_core = True
+    for ssp, variables in staged._swat_units():
+        staged._convert_swat_unit(ssp, variables, incremental=False, chunk_cells=64, stage_cells=100)
+    station_files = {path: data for path, data in memory.items() if os.path.dirname(path)}
+    assert read_outputs(tmp_path / f"{MODEL}_staged_SWAT_files") == station_files
+    assert os.listdir(staged._scratch_dir()) == []
+
+
+def interrupted(writer_class):
+    # A writer whose run dies after its first appended block of cells, before the unit is recorded
+    class InterruptedWriter(writer_class):
+        def append(self, *args):
+            super().append(*args)
+            raise RuntimeError("interrupted")
+    return InterruptedWriter()
+
+
+def test_appended_years_match_full_rewrite(tmp_path, capsys):
+    synthetic_archive(tmp_path)
+    downloader(tmp_path).export(["swat", "swatplus"])
+    make_synthetic_archive(tmp_path, MODEL, MEMBER, SSPS[1:], VARIABLES, [], [2016], NLAT, NLON)
+    for writer_class in [SwatWriter, SwatPlusWriter]:
+        with pytest.raises(RuntimeError):
+            downloader(tmp_path).export([interrupted(writer_class)], max_memory=1)
+    capsys.readouterr()
+    # The partly extended unit is rewritten, the others append
+    downloader(tmp_path).export(["swat", "swatplus"])
+    out = capsys.readouterr().out
+    assert "appended" in out and "written" in out
+    downloader(tmp_path, "_full").export(["swat", "swatplus"], incremental=False)
+
+    assert read_outputs(tmp_path / f"{MODEL}_SWAT_files") == read_outputs(tmp_path / f"{MODEL}_full_SWAT_files")
+    # SWAT+ files start with the time they were written at
+    swatplus = [{path: data.split(b'\n', 1)[1] for path, data in read_outputs(folder).items()}
+                for folder in [tmp_path / f"{MODEL}_SWATplus_files", tmp_path / f"{MODEL}_full_SWATplus_files"]]
+    assert swatplus[0] == swatplus[1]
+
+
+def download_pr(working_dir, server, tile_deg, engine, basin=None):
+    os.makedirs(working_dir)
+    if basin is None:
+        write_synthetic_shapefile(working_dir, 3, 4)
+    else:
+        gpd.GeoDataFrame({"Subbasin": [1]}, geometry=[basin], crs="EPSG:4326").to_file(working_dir / "subs1.shp")
+    instance = ClimateDataDownloader(str(working_dir), DATASET, MODEL, ["historical"], MEMBER, ["pr"], VERSIONS)
+    instance.ncss_url, instance.timeout, instance.tile_deg = server.ncss_url, 0.05, tile_deg
+    instance.dates_historical = range(1950, 1953)
+    if engine == "async":
+        instance.download_all_async()
+    else:
+        instance.download_all(batch_target_mb=1 if engine == "batch" else None)
+    instance.metrics.flush()
+    arrays = {}
+    for file_path in sorted(glob.glob(f"{working_dir}/{DATASET}/{MODEL}/historical/{MEMBER}/pr/*.nc")):
+        with nc.Dataset(file_path) as data_file:
+            arrays[os.path.basename(file_path)] = [data_file[name][:].filled(np.nan) for name in ["pr", "lat", "lon"]]
+    return arrays
+
+
+@pytest.mark.parametrize("basin, tile_deg", [
+    (None, 0.25),  # 3 x 4 cells
+    (shapely.box(-96.48, 39.75, -96.44, 41.0), 0.5),  # narrower than a cell, with no cell centre across it
+])
+def test_tiled_download_matches_untiled(tmp_path, basin, tile_deg):
+    # Tiles split the domain into several requests, stitched back into the same yearly files
+    server = start_server()
+    try:
+        for engine in ["single", "batch"] + (["async"] if aiohttp is not None else []):
+            start = server.stats["requests"]
+            untiled = download_pr(tmp_path / f"{engine}_untiled", server, None, engine, basin)
+            middle = server.stats["requests"]
+            tiled = download_pr(tmp_path / f"{engine}_tiled", server, tile_deg, engine, basin)
+            assert server.stats["requests"] - middle > middle - start
+            assert len(untiled) == 3 and tiled.keys() == untiled.keys()
+            for filename, arrays in untiled.items():
+                for stitched, whole in zip(tiled[filename], arrays):
+                    np.testing.assert_array_equal(stitched, whole)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))